@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Beschreibung
+-------------------------------------------------------------------------------
+Kommandozeilenversion des Exports ohne GUI, z.B. für nächtliche Läufe per cron
+auf einem Server ohne Display. Sucht alle Pläne im DICOM-Verzeichnis, ordnet
+ihnen die DynaLogs zu und rekonstruiert jede vollständig geloggte Fraktion
+über einen export_scheduler. Fortschritt, Zeiten und Ergebnis werden als
+JSON, ein Objekt pro Zeile, auf stdout ausgegeben.
+
+Aufruf
+-------------------------------------------------------------------------------
+python batch_export.py <dicomdir> <dynadir> <outputdir> [Optionen]
+
+Der Rückgabewert ist 0, wenn alle Exporte erfolgreich waren, sonst 1.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from import_tools import dynalog_cache, plan_cache, plan_scan, bank_scan
+from index_tools import log_index
+from export_tools import export_scheduler
+
+def report(event,**values):
+    """
+    Gibt ein Ereignis als einzeilige JSON-Nachricht aus.
+    """
+    values["event"] = event
+    sys.stdout.write(json.dumps(values,sort_keys=True)+"\n")
+    sys.stdout.flush()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reconstruct DICOM plans "
+        "from DynaLog files without the GUI.")
+    parser.add_argument("dicomdir",help="directory searched for RTPLAN files")
+    parser.add_argument("dynadir",help="directory searched for DynaLog files")
+    parser.add_argument("outputdir",help="directory for the exported plans")
+    parser.add_argument("--workers",type=int,
+        default=max(1,multiprocessing.cpu_count()-1),
+        help="size of the process pool (default: CPU count - 1)")
+    parser.add_argument("--retries",type=int,default=1,
+        help="retries for fractions failing with I/O errors (default: 1)")
+    parser.add_argument("--expected",action="store_true",
+        help="export expected instead of actual leaf positions")
+    parser.add_argument("--leafgap",type=float,default=0.7,
+        help="minimum dynamic leaf gap in mm (default: 0.7)")
+    parser.add_argument("--interpolate",action="store_true",
+        help="interpolate log data at the planned control points")
+    parser.add_argument("--criterion",choices=["angle","dose","segment"],
+        default="angle",help="control point matching (default: angle)")
+    parser.add_argument("--state",default=os.path.join(os.path.expanduser("~"),
+        ".dynalog_inspector"),help="directory for index and caches, shared "
+        "with the GUI; empty string disables them")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    start = time.time()
+
+    cache = None
+    plans_cache = None
+    index = None
+    if args.state != "":
+        cache = dynalog_cache(os.path.join(args.state,"cache"))
+        plans_cache = plan_cache(os.path.join(args.state,"plans"))
+        index = log_index(os.path.join(args.state,"index.sqlite"))
+    if not os.path.isdir(args.outputdir):
+        os.makedirs(args.outputdir)
+
+    plans = plan_scan(args.dicomdir,args.workers,index,plans_cache)
+    plans.refresh()
+    banks = bank_scan(args.dynadir,header_only=True,cache=cache,compact=True,
+        workers=args.workers,index=index)
+    banks.refresh()
+    report("scan",plans=len(plans.plans),banks=len(banks.files),
+        seconds=round(time.time()-start,3))
+
+    scheduler = export_scheduler(args.workers,args.retries,cache)
+    for plan in plans.plans:
+        pools = banks.grouping.deliveries(plan.header["plan_uid"],2*plan.arcs)
+        if len(pools) == 0:
+            report("skip",plan_uid=plan.header["plan_uid"],
+                plan_name=plan.header["plan_name"],
+                reason="no complete delivery")
+            continue
+        scheduler.add(plan,pools,args.outputdir,args.expected,args.leafgap,
+            args.interpolate,args.criterion)
+    report("start",jobs=len(scheduler.jobs),workers=args.workers)
+
+    def progress(entry):
+        report("job",plan_uid=entry["plan_uid"],plan_name=entry["plan_name"],
+            status=entry["status"],attempts=entry["attempts"],
+            fractions=[{"target":target,"status":status,"message":message,
+            "seconds":round(seconds,3)} for target,status,message,seconds
+            in entry["fractions"]])
+
+    results = scheduler.run(progress)
+    if index != None:
+        index.close()
+    failed = [entry for entry in results if entry["status"] != "ok"]
+    report("done",jobs=len(results),ok=len(results)-len(failed),
+        failed=len(failed),seconds=round(time.time()-start,3))
+    return 0 if len(failed) == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Klassen
+-------------------------------------------------------------------------------
+export_scheduler :
+    Verteilt die Rekonstruktion und den Export von Plänen auf einen Prozesspool
+    fester Größe.
+
+Beschreibung
+-------------------------------------------------------------------------------
+Jeder Plan mit allen seinen vollständig geloggten Fraktionen bildet einen Job.
+An die Arbeitsprozesse werden nur Dateinamen und Header übergeben, Plan und
+Leafbänke werden dort neu geöffnet. Zurück kommen reine Statustupel, sodass
+Fehler eines Jobs weder den Pool noch die übrigen Jobs beeinträchtigen.
+"""
+
+import os
+import time
+import multiprocessing
+import plan_logic as pl
+import import_tools as it
+
+def _error_status(error):
+    """
+    Ausgabe
+    ---------------------------------------------------------------------------
+    output : str
+        "error" für Lese- und Schreibfehler, die bei einem erneuten Versuch
+        verschwinden können, sonst "failed".
+    """
+    if isinstance(error,EnvironmentError):
+        return "error"
+    return "failed"
+
+def _export_job(job):
+    """
+    Arbeitsfunktion für export_scheduler.run im Prozesspool. Rekonstruiert und
+    exportiert alle Fraktionen eines Jobs nacheinander. Exceptions werden
+    abgefangen und als Status zurückgegeben, da Python 2 für Pool.map_async
+    keinen error_callback kennt. Lese- und Schreibfehler (EnvironmentError)
+    erhalten den Status "error" und dürfen wiederholt werden, alle anderen,
+    z.B. PlanMismatchError oder BeamMismatchError, den Status "failed".
+
+    Ausgabe
+    ---------------------------------------------------------------------------
+    output : tuple (int, list of tuple)
+        Job-Nummer und je Fraktion (Zieldatei, "ok", "error" oder "failed",
+        Fehlertext, Dauer in Sekunden).
+    """
+    results = []
+    start = time.time()
+    try:
+        plan = pl.plan(job["plan_file"],job["header"],job["arcs"],
+            data=job["data"])
+    except Exception as error:
+        return job["job_id"],[(fraction["target"],_error_status(error),
+            "{0}: {1}".format(type(error).__name__,error),time.time()-start)
+            for fraction in job["fractions"]]
+
+    for fraction in job["fractions"]:
+        start = time.time()
+        try:
+            banks = [it.leafbank_dynalog(filename,side,
+                it.filetools.bank_columns,cache=job["cache"],compact=True)
+                for filename,side in fraction["banks"]]
+            plan.construct_logbeams(banks)
+            plan.validate_plan()
+            plan.export_dynalog_plan(job["header"]["plan_name"],
+                fraction["target"],**job["options"])
+        except Exception as error:
+            results.append((fraction["target"],_error_status(error),
+                "{0}: {1}".format(type(error).__name__,error),
+                time.time()-start))
+        else:
+            results.append((fraction["target"],"ok","",time.time()-start))
+    plan.release()
+    return job["job_id"],results
+
+class export_scheduler:
+
+    def __init__(self,workers=None,retries=1,cache=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        workers : int, default None
+            Größe des Prozesspools. Bei None oder 1 wird alles im aufrufenden
+            Prozess exportiert.
+
+        retries : int, default 1
+            Wie oft fehlgeschlagene Fraktionen erneut versucht werden.
+
+        cache : import_tools.dynalog_cache, default None
+            Cache, über den die Arbeitsprozesse die DynaLogs öffnen.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        export_name :
+            Bereinigter Dateiname eines Plans.
+
+        add :
+            Legt einen Job für einen Plan und seine Fraktionen an.
+
+        run :
+            Führt alle Jobs aus und liefert den Bericht.
+
+        cancel :
+            Bricht einen laufenden run ab.
+
+        Instanzvariablen
+        -----------------------------------------------------------------------
+        jobs : list of dict
+            Alle angelegten Jobs.
+
+        report : dict
+            Je Job-Nummer plan_uid, plan_name, status ("pending", "ok",
+            "error" oder "cancelled"), attempts und fractions, eine Liste der
+            Statustupel (Zieldatei, Status, Fehlertext, Dauer). Fraktionen
+            haben den Status "ok", "error" (Lese- oder Schreibfehler) oder
+            "failed" (Plan und DynaLogs passen nicht zusammen).
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Ersetzt einen Thread pro Plan durch einen Pool mit fester Prozesszahl.
+        Zieldateien werden vollständig als Pfad übergeben, das Arbeits-
+        verzeichnis des Prozesses wird nie gewechselt.
+        """
+        self.workers = workers
+        self.retries = retries
+        self.cache = cache
+        self.jobs = []
+        self.report = {}
+        self.cancelled = False
+        self.pool = None
+
+    @classmethod
+    def export_name(self,plan):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : str
+            Patientenname und Planname, ohne alle Zeichen, die nicht Buchstabe
+            oder Ziffer sind.
+        """
+        name = "".join([plan.header["patient_name"][0],
+            plan.header["patient_name"][1],plan.header["plan_name"]])
+        return "".join(c for c in name if c.isalnum())
+
+    def add(self,plan,pools,directory,export_expected=False,leafgap=0.7,
+        interpolate=False,criterion="angle"):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        plan : plan object
+            Plan, möglichst aus einem Dateinamen erzeugt (siehe plan_scan).
+
+        pools : list of list
+            Leafbänke je Fraktion, siehe bank_groups.deliveries.
+
+        directory : str
+            Ausgabeverzeichnis. Bei mehreren Fraktionen wird an den Dateinamen
+            _F<Nummer> angehängt.
+
+        export_expected, leafgap, interpolate, criterion :
+            Siehe plan.export_dynalog_plan.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : int
+            Nummer des Jobs.
+        """
+        name = self.export_name(plan)
+        fractions = []
+        for num in range(len(pools)):
+            if len(pools) > 1:
+                target = "{0}_F{1}.dcm".format(name,num+1)
+            else:
+                target = name + ".dcm"
+            fractions.append({"target":os.path.join(str(directory),target),
+                "banks":[(bank.header["filename"],bank.header["side"])
+                for bank in pools[num]]})
+
+        plan_file = plan.__dict__.get("filename")
+        if plan_file == None:
+            plan_file = plan.dicom_data.filename
+
+        job = {"job_id":len(self.jobs),"plan_file":plan_file,
+            "header":dict(plan.header),"arcs":plan.arcs,
+            "data":plan.__dict__.get("data"),"fractions":fractions,
+            "cache":self.cache,"options":{"export_expected":export_expected,
+            "leafgap":leafgap,"interpolate":interpolate,
+            "criterion":criterion}}
+        self.jobs.append(job)
+        self.report[job["job_id"]] = {"plan_uid":plan.header["plan_uid"],
+            "plan_name":plan.header["plan_name"],"status":"pending",
+            "attempts":0,"fractions":[]}
+        return job["job_id"]
+
+    def run(self,progress=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        progress : callable, default None
+            Wird nach jedem abgeschlossenen Job mit dessen Berichtseintrag
+            aufgerufen, z.B. zur Fortschrittsanzeige.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Führt alle noch nicht erfolgreichen Jobs aus. Fraktionen, deren Export
+        an einem Lese- oder Schreibfehler scheitert, werden bis zu retries Mal
+        als eigener Job wiederholt. Fraktionen mit Status "failed" scheitern
+        bei jedem Versuch gleich und werden nicht wiederholt.
+        Nach cancel werden keine weiteren Jobs gestartet, laufende Prozesse
+        werden sofort beendet und offene Jobs als "cancelled" markiert.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of dict
+            Berichtseinträge aller Jobs, siehe report.
+        """
+        self.cancelled = False
+        pending = [job for job in self.jobs
+            if self.report[job["job_id"]]["status"] != "ok"]
+        for attempt in range(self.retries+1):
+            if len(pending) == 0 or self.cancelled == True:
+                break
+            pending = self.run_jobs(pending,progress)
+
+        for entry in self.report.values():
+            if entry["status"] == "pending":
+                entry["status"] = "cancelled"
+        return [self.report[job["job_id"]] for job in self.jobs]
+
+    def run_jobs(self,jobs,progress=None):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of dict
+            Jobs mit den Fraktionen, die an einem Lese- oder Schreibfehler
+            gescheitert sind, für den nächsten Versuch.
+        """
+        failed = []
+        if self.workers == None or self.workers <= 1:
+            pool = None
+            results = (_export_job(job) for job in jobs)
+        else:
+            pool = multiprocessing.Pool(self.workers)
+            self.pool = pool
+            results = pool.imap_unordered(_export_job,jobs)
+        by_id = dict([(job["job_id"],job) for job in jobs])
+        try:
+            while self.cancelled == False:
+                try:
+                    if pool == None:
+                        job_id,fractions = next(results)
+                    else:
+                        job_id,fractions = results.next(0.5)
+                except StopIteration:
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+                #Mit Timeout, damit ein Abbruch nicht auf das Ende des
+                #laufenden Jobs warten muss.
+                entry = self.report[job_id]
+                entry["attempts"] += 1
+                done = dict([(fraction[0],fraction) for fraction in
+                    entry["fractions"]])
+                done.update([(fraction[0],fraction) for fraction in fractions])
+                entry["fractions"] = sorted(done.values())
+                errors = [fraction[0] for fraction in fractions
+                    if fraction[1] == "error"]
+                entry["status"] = "ok"
+                if any(fraction[1] != "ok" for fraction in entry["fractions"]):
+                    entry["status"] = "error"
+                if len(errors) > 0:
+                    retry = dict(by_id[job_id])
+                    retry["fractions"] = [fraction for fraction in
+                        by_id[job_id]["fractions"] if fraction["target"] in errors]
+                    failed.append(retry)
+                if progress != None:
+                    progress(entry)
+        finally:
+            if pool != None:
+                if self.cancelled == True:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+                self.pool = None
+        return failed
+
+    def cancel(self):
+        """
+        Bricht run ab. Kann aus einem anderen Thread aufgerufen werden; die
+        Prozesse des Pools werden sofort beendet, ohne auf laufende Jobs zu
+        warten. Ohne Pool wird nach dem aktuellen Job abgebrochen.
+        """
+        self.cancelled = True
+        pool = self.pool
+        if pool != None:
+            pool.terminate()
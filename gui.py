@@ -6,10 +6,12 @@ Created on Mon May 02 10:23:12 2016
 """
 import numpy as np
 from PyQt4 import uic, QtGui, QtCore
-from import_tools import filetools as ft
+from import_tools import dynalog_cache, plan_cache, plan_scan, bank_scan
+from index_tools import log_index
+from export_tools import export_scheduler
 import os
-import plan_logic
 import threading
+import multiprocessing
 
 import matplotlib
 matplotlib.use("Qt4Agg")
@@ -23,6 +25,7 @@ Ui_Mainwindow, QMainwindow = uic.loadUiType("master.ui")
 class Main(QMainwindow,Ui_Mainwindow):
 
     progress = QtCore.pyqtSignal()
+    export_finished = QtCore.pyqtSignal(object,object)
 
     def __init__(self,):
         super(Main,self).__init__()
@@ -30,6 +33,7 @@ class Main(QMainwindow,Ui_Mainwindow):
         self.table_plans.resizeColumnsToContents()
 
         self.progress.connect(self.update_bar)
+        self.export_finished.connect(self.show_export_report)
 
         self.button_dicomdir.clicked.connect(self.pick_dicomdir)
         self.edit_dicomdir.editingFinished.connect(self.populate_table)
@@ -43,6 +47,18 @@ class Main(QMainwindow,Ui_Mainwindow):
 
         self.plans = []
         self.banks = {}
+        self.cache = dynalog_cache(os.path.join(os.path.expanduser("~"),
+            ".dynalog_inspector","cache"))
+        self.plan_cache = plan_cache(os.path.join(os.path.expanduser("~"),
+            ".dynalog_inspector","plans"))
+        self.index = log_index(os.path.join(os.path.expanduser("~"),
+            ".dynalog_inspector","index.sqlite"))
+        self.plan_scanner = None
+        self.bank_scanner = None
+        self.stat_scanner = None
+        #Merken sich bereits gelesene Dateien, Refresh liest nur Änderungen.
+        self.scheduler = None
+        self.export_worker = None
 
         self.edit_stat_dynadir.editingFinished.connect(self.stat_dir_updated)
         self.button_stat_dynadir.clicked.connect(self.stat_dir_button)
@@ -51,7 +67,7 @@ class Main(QMainwindow,Ui_Mainwindow):
 
         self.button_stat_refresh.clicked.connect(self.stat_dir_updated)
 
-        self.dropdown_settings_statpick.currentIndexChanged.connect(self.stat_dir_updated)
+        self.dropdown_settings_statpick.currentIndexChanged.connect(self.stat_mode_changed)
 
     def pick_dicomdir(self):
         """
@@ -89,8 +105,19 @@ class Main(QMainwindow,Ui_Mainwindow):
         für deren Rekonstruktion vorhanden sind.
         """
         if skip == False:
-            self.plans = ft.get_plans(self.edit_dicomdir.text())
-            self.banks = ft.get_banks(self.edit_dynadir.text())
+            dicomdir = str(self.edit_dicomdir.text())
+            if self.plan_scanner == None or self.plan_scanner.top != dicomdir:
+                self.plan_scanner = plan_scan(dicomdir,index=self.index,
+                    cache=self.plan_cache)
+            self.plan_scanner.refresh()
+            self.plans = self.plan_scanner.plans
+
+            dynadir = str(self.edit_dynadir.text())
+            if self.bank_scanner == None or self.bank_scanner.top != dynadir:
+                self.bank_scanner = bank_scan(dynadir,header_only=True,
+                    cache=self.cache,compact=True,index=self.index)
+            self.bank_scanner.refresh()
+            self.banks = self.bank_scanner.groups
         self.table_plans.setSortingEnabled(False)
         self.table_plans.setRowCount(len(self.plans))
 
@@ -103,17 +130,23 @@ class Main(QMainwindow,Ui_Mainwindow):
             self.table_plans.setItem(num,3,QtGui.QTableWidgetItem(
                 self.plans[num].header["plan_uid"]))
             self.table_plans.setItem(num,2,QtGui.QTableWidgetItem("N/A"))
-            try:
-                complete = len(self.banks[self.plans[num].header["plan_uid"]])\
-                    == 2*self.plans[num].arcs
-            except KeyError:
-                complete = False
+            complete = len(self.complete_deliveries(self.plans[num])) > 0
             answer = {True:"Ja",False:"Nein"}
             self.table_plans.setItem(num,2,QtGui.QTableWidgetItem(answer[complete]))
 
         self.table_plans.resizeColumnsToContents()
         self.table_plans.setSortingEnabled(True)
 
+    def complete_deliveries(self,plan):
+        """
+        Liefert für jede vollständig geloggte Bestrahlung (Fraktion) des Plans
+        die Liste ihrer Leafbänke.
+        """
+        if self.bank_scanner == None:
+            return []
+        return self.bank_scanner.grouping.deliveries(plan.header["plan_uid"],
+            2*plan.arcs)
+
     def update_bar(self):
         """
         Funktion für Fortschrittsanzeige. Falls alle Aktionen beendet sind, wird
@@ -125,42 +158,81 @@ class Main(QMainwindow,Ui_Mainwindow):
 
     def export_thread(self):
         """
-        Schiebt die Exportvorgänge an (in eigenen Threads, damit das Hauptfenster
-        noch ansprechbar bleibt).
+        Schiebt die Exportvorgänge an. Alle Pläne werden als Jobs an einen
+        export_scheduler übergeben, der sie in einem Prozesspool abarbeitet;
+        gewartet wird in einem eigenen Thread, damit das Hauptfenster noch
+        ansprechbar bleibt.
         """
-        self.progressbar_export.setMinimum(1)
-        self.progressbar_export.setValue(1)
+        if self.scheduler != None:
+            self.scheduler.cancel()
+        self.scheduler = export_scheduler(max(1,multiprocessing.cpu_count()-1),
+            cache=self.cache)
+        for plan in self.plans:
+            pools = self.complete_deliveries(plan)
+            if len(pools) > 0:
+                self.scheduler.add(plan,pools,str(self.edit_outputdir.text()),
+                    self.checkbox_exportexpected.isChecked(),
+                    self.spinbox_leafgap.value())
+
+        self.progressbar_export.setMinimum(0)
+        self.progressbar_export.setValue(0)
+        self.progressbar_export.setMaximum(max(1,len(self.scheduler.jobs)))
+        if len(self.scheduler.jobs) == 0:
+            return None
         self.busybar.setMaximum(0)
-        self.progressbar_export.setMaximum(len(self.banks.keys())-1)
+        self.export_worker = threading.Thread(target=self.run_export,
+            args=(self.scheduler,))
+        self.export_worker.daemon = True
+        self.export_worker.start()
+        #daemon, damit ein hängender Export das Beenden nicht blockiert.
 
-        for plan in self.plans:
-            try:
-                if 2*plan.arcs == len(self.banks[plan.header["plan_uid"]]):
-                    t = threading.Thread(target=self.export,args=(plan,))
-                    t.start()
-            except KeyError:
-                pass
-            except:
-                raise
-
-    def export(self,plan):
-        """
-        Die eigentliche Exportarbeit, die jeweils im eigenen Thread aufgerufen wird.
-        """
-        delchars = "".join(c for c in map(chr, range(256)) if not c.isalnum())
-
-        filename = "_".join([plan.header["patient_name"][0],plan.header["patient_name"][1],plan.header["plan_name"]])
-        filename = filename.replace(" ","_")
-        filename = filename.translate(None,delchars) + ".dcm"
-        try:
-            plan.construct_logbeams(self.banks[plan.header["plan_uid"]])
-            plan.validate_plan()
-            os.chdir(str(self.edit_outputdir.text()))
-            plan.export_dynalog_plan(plan.header["plan_name"],filename,self.checkbox_exportexpected.isChecked(),self.spinbox_leafgap.value())
+    def run_export(self,scheduler):
+        """
+        Läuft im Exportthread. Der Bericht des export_scheduler wird über das
+        Signal export_finished an das Hauptfenster übergeben.
+        """
+        results = scheduler.run(self.export_progress)
+        self.export_finished.emit(scheduler,results)
+
+    def show_export_report(self,scheduler,results):
+        """
+        Zeigt nach einem Exportlauf das Ergebnis in der Statusleiste an und
+        listet fehlgeschlagene Pläne mit ihren Fehlermeldungen auf. Berichte
+        eines abgebrochenen oder inzwischen ersetzten Laufs werden ignoriert.
+        """
+        if scheduler is not self.scheduler or scheduler.cancelled == True:
+            return None
+        self.busybar.setMaximum(1)
+        failed = [entry for entry in results if entry["status"] != "ok"]
+        self.statusbar.showMessage(u"Export beendet: {0} von {1} Plänen "
+            "erfolgreich.".format(len(results)-len(failed),len(results)))
+        if len(failed) == 0:
+            return None
+        lines = []
+        for entry in failed:
+            for target,status,message,seconds in entry["fractions"]:
+                if status != "ok":
+                    lines.append("{0} ({1}): {2}".format(entry["plan_name"],
+                        os.path.basename(target),message))
+        QtGui.QMessageBox.warning(self,u"Export fehlgeschlagen",
+            u"{0} Pläne konnten nicht exportiert werden:\n\n{1}".format(
+            len(failed),"\n".join(lines)))
+
+    def export_progress(self,entry):
+        """
+        Wird vom export_scheduler nach jedem Job aufgerufen (im Exportthread,
+        daher nur über das progress-Signal). Wiederholungsversuche zählen
+        nicht erneut.
+        """
+        if entry["attempts"] == 1:
             self.progress.emit()
 
-        except (KeyError,IndexError,plan_logic.PlanMismatchError):
-            raise
+    def closeEvent(self,event):
+        if self.scheduler != None:
+            self.scheduler.cancel()
+        if self.export_worker != None:
+            self.export_worker.join(5)
+        event.accept()
 
     def stat_dir_button(self):
         statdir = QtGui.QFileDialog.getExistingDirectory(self,"DynaLog-Verzeichnis")
@@ -169,28 +241,48 @@ class Main(QMainwindow,Ui_Mainwindow):
         self.stat_dir_updated()
 
     def stat_dir_updated(self):
-        self.stat_pool = ft.get_banks(self.edit_stat_dynadir.text(),self.dropdown_settings_statpick.currentText())
+        statdir = str(self.edit_stat_dynadir.text())
+        mode = str(self.dropdown_settings_statpick.currentText())
+        if self.stat_scanner == None or self.stat_scanner.top != statdir:
+            self.stat_scanner = bank_scan(statdir,mode,header_only=True,
+                cache=self.cache,compact=True,index=self.index,summaries=True)
+        elif self.stat_scanner.mode != mode:
+            self.stat_scanner.set_mode(mode)
+        self.stat_scanner.refresh()
+        self.fill_stat_dropdown()
+
+    def stat_mode_changed(self):
+        """
+        Wechselt nur die Gruppierung des Statistik-Pools, das Verzeichnis wird
+        dafür nicht neu durchsucht.
+        """
+        if self.stat_scanner == None:
+            return self.stat_dir_updated()
+        self.stat_scanner.set_mode(str(self.dropdown_settings_statpick.currentText()))
+        self.fill_stat_dropdown()
+
+    def fill_stat_dropdown(self):
+        self.stat_pool = self.stat_scanner.groups
 
         self.dropdown_stat_patients.clear()
         self.dropdown_stat_patients.addItem("Alles")
         self.dropdown_stat_patients.addItems(self.stat_pool.keys())
 
     def stat_calculation(self):
-        stat_banks = []
+        """
+        Vereinigt die beim Einlesen im Index abgelegten Leafstatistiken der
+        gewählten Leafbänke je Seite. Leafdaten werden nur für Dateien ohne
+        gespeicherte Zusammenfassung gelesen.
+        """
         if self.dropdown_stat_patients.currentText() == "Alles":
-            for group in self.stat_pool.items():
-                for item in group[1]:
-                    item.stats()
-                    stat_banks.append(item)
+            stat_banks = [item for group in self.stat_pool.values()
+                for item in group]
         else:
-            for item in self.stat_pool[self.dropdown_stat_patients.currentText()]:
-                item.stats()
-                stat_banks.append(item)
+            stat_banks = self.stat_pool[str(self.dropdown_stat_patients.currentText())]
 
         self.leafcount = stat_banks[0].header["leaf_count"]
-        self.stat_diff_a = np.concatenate([bank.leafdifference for bank in stat_banks if bank.header["side"] == "A"])/100
-        self.stat_diff_b = np.concatenate([bank.leafdifference for bank in stat_banks if bank.header["side"] == "B"])/100
-
+        self.stat_diff = dict([(side,self.stat_scanner.summary([bank for bank
+            in stat_banks if bank.header["side"] == side])) for side in "AB"])
 
     def show_stats(self):
         self.stat_calculation()
@@ -202,23 +294,33 @@ class Main(QMainwindow,Ui_Mainwindow):
         figure_a = Figure()
         graph_a = figure_a.add_subplot(111)
 
-        self.a_mean, = graph_a.plot(np.arange(self.leafcount),np.mean(self.stat_diff_a,axis=0),"bx",label="Mittel")
-        self.a_min, = graph_a.plot(np.arange(self.leafcount),np.min(self.stat_diff_a,axis=0),"gx",label="Minimum")
-        self.a_max, = graph_a.plot(np.arange(self.leafcount),np.max(self.stat_diff_a,axis=0),"rx",label="Maximum")
+        if self.stat_diff["A"].count > 0:
+            self.a_mean, = graph_a.plot(np.arange(self.leafcount),self.stat_diff["A"].mean/100,"bx",label="Mittel")
+            self.a_min, = graph_a.plot(np.arange(self.leafcount),self.stat_diff["A"].minimum/100,"gx",label="Minimum")
+            self.a_max, = graph_a.plot(np.arange(self.leafcount),self.stat_diff["A"].maximum/100,"rx",label="Maximum")
+            graph_a.legend(loc="lower left")
+        else:
+            graph_a.text(0.5,0.5,u"–",ha="center",va="center",
+                transform=graph_a.transAxes)
+            #Keine Leafbänke dieser Seite in der Auswahl.
         graph_a.set_xlabel("Leaf #")
         graph_a.set_ylabel("Abweichung / mm")
-        graph_a.legend(loc="lower left")
         self.plot(figure_a,"a")
 
         figure_b = Figure()
         graph_b = figure_b.add_subplot(111)
 
-        self.b_mean, = graph_b.plot(np.arange(self.leafcount),np.mean(self.stat_diff_b,axis=0),"bx",label="Mittel")
-        self.b_min, = graph_b.plot(np.arange(self.leafcount),np.min(self.stat_diff_b,axis=0),"gx",label="Minimum")
-        self.b_max, = graph_b.plot(np.arange(self.leafcount),np.max(self.stat_diff_b,axis=0),"rx",label="Maximum")
+        if self.stat_diff["B"].count > 0:
+            self.b_mean, = graph_b.plot(np.arange(self.leafcount),self.stat_diff["B"].mean/100,"bx",label="Mittel")
+            self.b_min, = graph_b.plot(np.arange(self.leafcount),self.stat_diff["B"].minimum/100,"gx",label="Minimum")
+            self.b_max, = graph_b.plot(np.arange(self.leafcount),self.stat_diff["B"].maximum/100,"rx",label="Maximum")
+            graph_b.legend(loc="lower left")
+        else:
+            graph_b.text(0.5,0.5,u"–",ha="center",va="center",
+                transform=graph_b.transAxes)
+            #Keine Leafbänke dieser Seite in der Auswahl.
         graph_b.set_xlabel("Leaf #")
         graph_b.set_ylabel("Abweichung / mm")
-        graph_b.legend(loc="lower left")
         self.plot(figure_b,"b")
 
     def plot(self,fig,target):
@@ -5,53 +5,603 @@ Created on Thu Jun 09 11:47:16 2016
 @author: mick
 """
 import os
+import io
+import sys
+import gzip
+import json
+import zipfile
+import contextlib
+import shutil
+import re
+import time
+import hashlib
+import itertools
+import tempfile
+import warnings
+import multiprocessing
 import numpy as np
 import plan_logic as pl
 import dicom as dcm
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+def _ingest_plan(args):
+    """
+    Arbeitsfunktion für filetools.get_plans im Prozesspool. Gibt das plan-
+    Objekt zurück, oder None falls die Datei kein RTPLAN mit Arcs ist. Nur
+    RTPLAN-Dateien werden komplett gelesen, siehe filetools.read_dicom_header,
+    und auch diese nicht, falls ihre Daten bereits im plan_cache liegen.
+    """
+    filename,cache = args
+    header = filetools.read_dicom_header(filename)
+    if header == None or getattr(header,"Modality",None) != "RTPLAN":
+        return None
+    if cache == None:
+        plan = pl.plan(filename)
+    else:
+        mtime = filetools.identity(filename)[2]
+        data = cache.load(header.SOPInstanceUID,mtime)
+        if data == None:
+            plan = pl.plan(filename)
+            cache.store(header.SOPInstanceUID,mtime,plan.data)
+        else:
+            plan = pl.plan(filename,data=data)
+    if plan.arcs > 0:
+        return plan
+    return None
+
+def _ingest_bank(args):
+    """
+    Arbeitsfunktion für filetools.get_banks im Prozesspool. Mit Cache wird
+    die Datei nur geparst und im Cache abgelegt, der Elternprozess öffnet das
+    Ergebnis dann per Memory-Mapping. Ohne Cache wird die Leafbank selbst
+    zurückgegeben.
+    """
+    filename,side,columns,cache,compact = args
+    bank = leafbank_dynalog(filename,side,columns,cache=cache,compact=compact)
+    if cache != None:
+        return None
+    return bank
+
+def _summarize_bank(args):
+    """
+    Arbeitsfunktion für bank_scan im Prozesspool. Liest die Leafdaten einer
+    Datei blockweise und gibt ihre leaf_statistics zurück.
+    """
+    filename,side,cache,compact = args
+    bank = leafbank_dynalog(filename,side,filetools.bank_columns,True,cache,
+        compact)
+    return leaf_statistics().add_bank(bank)
 
 class filetools:
 
+    compressions = [".gz",".xz"]
+    #Komprimierte Einzeldateien, die open_file direkt lesen kann.
+
+    archive_members = {}
+    #Absoluter Pfad eines zip-Archivs -> ((Größe, Änderungszeit), Dateiliste),
+    #damit find_files nur geänderte Archive erneut öffnet.
+
     @classmethod
-    def get_plans(self,top):
-        dicom_files = []
+    def find_files(self,top,ending,archives=False):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        top : str
+            Verzeichnis, das rekursiv durchsucht wird.
+
+        ending : str
+            Dateiendung, z.B. "dcm" oder "dlg".
+
+        archives : boolean, default False
+            Findet zusätzlich komprimierte Dateien (<ending>.gz, <ending>.xz)
+            und passende Dateien innerhalb von zip-Archiven. Letztere werden
+            als "<archiv>.zip<os.sep><pfad im archiv>" zurückgegeben, siehe
+            split_archive. Die Dateiliste eines Archivs wird in
+            archive_members gehalten und nur neu gelesen, wenn sich Größe oder
+            Änderungszeit des Archivs (siehe identity) geändert haben.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of tuple
+            (Pfad, Dateiname) aller passenden Dateien, sortiert nach Pfad,
+            damit die Reihenfolge unabhängig von os.walk reproduzierbar ist.
+        """
+        output = []
         for root,dirs,files in os.walk(str(top)):
             for f in files:
-                if f[-3:] == "dcm":
-                    filename = "\\".join([root,f])
-                    dicom_files.append(dcm.read_file(filename))
-        plans = [pl.plan(plan) for plan in dicom_files if plan.Modality == "RTPLAN"]
-        return [plan for plan in plans if (plan.arcs > 0) == True]
+                filename = os.path.join(root,f)
+                if f[-len(ending):] == ending:
+                    output.append((filename,f))
+                elif archives == False:
+                    continue
+                elif f[-3:] in self.compressions and f[:-3][-len(ending):] == ending:
+                    output.append((filename,f))
+                elif f[-4:].lower() == ".zip":
+                    try:
+                        members = self.list_archive(filename)
+                    except (IOError,OSError,zipfile.BadZipfile):
+                        continue
+                    for member in members:
+                        if member[-len(ending):] == ending:
+                            output.append((os.path.join(filename,member),
+                                member.split("/")[-1]))
+        return sorted(output)
 
     @classmethod
-    def get_banks(self,top,mode="plan_uid"):
-        banks = []
-        for root,dirs,files in os.walk(str(top)):
-            for f in files:
-                if f[-3:] == "dlg":
-                    filename = "\\".join([root,f])
-                    banks.append(leafbank_dynalog(filename,f[0]))
+    def list_archive(self,filename):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of str
+            Namen aller Dateien im zip-Archiv filename, aus archive_members,
+            solange das Archiv unverändert ist.
+        """
+        path,size,mtime = self.identity(filename)
+        cached = self.archive_members.get(path)
+        if cached != None and cached[0] == (size,mtime):
+            return cached[1]
+        with zipfile.ZipFile(filename) as archive:
+            members = archive.namelist()
+        self.archive_members[path] = ((size,mtime),members)
+        return members
+
+    @classmethod
+    def split_archive(self,filename):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str
+            Pfad, ggf. in der Form "<archiv>.zip/<pfad im archiv>" (bzw. mit
+            "\\" unter Windows).
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : tuple (str, str) or None
+            Pfad des zip-Archivs und Name der Datei im Archiv, None falls
+            filename kein Archivinhalt ist.
+        """
+        lower = filename.lower()
+        start = 0
+        while True:
+            index = lower.find(".zip",start)
+            if index == -1:
+                return None
+            end = index + 4
+            if lower[end:end+1] in ["\\","/"] and os.path.isfile(filename[:end]):
+                return filename[:end],filename[end+1:].replace("\\","/")
+            start = end
+
+    @classmethod
+    def identity(self,filename):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : tuple (str, int, float)
+            Absoluter Pfad, Größe und Änderungszeit der Datei. Bei Dateien in
+            zip-Archiven werden Größe und Änderungszeit des Archivs verwendet.
+        """
+        archive = self.split_archive(filename)
+        stat = os.stat(filename if archive == None else archive[0])
+        return os.path.abspath(filename),stat.st_size,stat.st_mtime
+
+    @classmethod
+    @contextlib.contextmanager
+    def open_file(self,filename):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str
+            Pfad einer Textdatei, einer .gz/.xz-komprimierten Textdatei oder
+            einer Datei in einem zip-Archiv (siehe split_archive).
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Öffnet die Datei zum zeilenweisen Lesen. Komprimierte Dateien werden
+        beim Lesen entpackt, nichts wird auf die Festplatte extrahiert. Als
+        Kontextmanager zu verwenden, schließt auch das zip-Archiv wieder.
+        """
+        mode = "r" if sys.version_info[0] == 2 else "rt"
+        archive = self.split_archive(filename)
+        if archive != None:
+            with zipfile.ZipFile(archive[0]) as data:
+                handle = data.open(archive[1])
+                if sys.version_info[0] > 2:
+                    handle = io.TextIOWrapper(handle)
+                try:
+                    yield handle
+                finally:
+                    handle.close()
+            return
+        if filename[-3:] == ".gz":
+            handle = gzip.open(filename,mode)
+        elif filename[-3:] == ".xz":
+            if lzma == None:
+                raise IOError("reading {0} requires the lzma module".format(filename))
+            handle = lzma.open(filename,mode)
+        else:
+            handle = open(filename,"r")
+        try:
+            yield handle
+        finally:
+            handle.close()
+
+    @classmethod
+    def get_plans(self,top,workers=None,cache=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        top : str
+            Verzeichnis, das rekursiv nach DICOM-Dateien durchsucht wird.
+
+        workers : int, default None
+            Anzahl der Prozesse, auf die das Einlesen verteilt wird. Bei None
+            oder 1 wird alles im aufrufenden Prozess gelesen.
+
+        cache : plan_cache, default None
+            Cache der ausgelesenen Plandaten. Pläne mit Eintrag werden ohne
+            vollständiges Parsen erzeugt.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of plan objects
+            Alle RTPLAN-Objekte mit mindestens einem Arc.
+        """
+        plans = self.load_plans([filename for filename,f in
+            self.find_files(top,"dcm")],workers,cache)
+        return [plan for plan in plans if plan != None]
+
+    @classmethod
+    def read_dicom_header(self,filename):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str
+            Pfad der DICOM-Datei.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Liest nur die führenden Elemente der Datei bis einschließlich Modality
+        (0008,0060), darunter auch SOPInstanceUID (0008,0018). Der Rest der
+        Datei, insbesondere Pixeldaten von CT-Serien oder Dosisgrids, wird
+        gar nicht erst gelesen. Reicht aus, um RTPLAN-Dateien zu erkennen.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dicom.dataset.Dataset or None
+            Teildatensatz, None falls die Datei kein gültiges DICOM ist.
+        """
+        with open(filename,"rb") as data:
+            try:
+                return dcm.filereader.read_partial(data,
+                    stop_when=lambda tag,VR,length: tag > 0x00080060)
+            except dcm.filereader.InvalidDicomError:
+                return None
+
+    @classmethod
+    def load_plans(self,filenames,workers=None,cache=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filenames : list of str
+            Pfade der DICOM-Dateien.
+
+        workers : int, default None
+            Anzahl der Prozesse, siehe get_plans.
+
+        cache : plan_cache, default None
+            Siehe get_plans.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list
+            Je Datei ein plan-Objekt oder None (kein RTPLAN bzw. keine Arcs).
+        """
+        args = [(filename,cache) for filename in filenames]
+        if workers == None or workers <= 1:
+            return [_ingest_plan(arg) for arg in args]
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_ingest_plan,args,chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+
+    bank_columns = ["dose","gantry","leafs"]
+    #Spalten, die für Rekonstruktion und Statistik benötigt werden.
+
+    @classmethod
+    def get_banks(self,top,mode="plan_uid",header_only=False,cache=None,
+        compact=False,workers=None,archives=True):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        top : str
+            Verzeichnis, das rekursiv nach DynaLog-Dateien durchsucht wird.
+
+        mode : str, default "plan_uid"
+            "plan_uid", "patient_id" oder "patient_name", Schlüssel nach dem
+            die Leafbänke gruppiert werden.
+
+        header_only : boolean, default False
+            Liest von jeder Datei nur den Header. Die Leafdaten werden erst
+            geladen, wenn beim Export oder der Statistik darauf zugegriffen wird.
+
+        cache : dynalog_cache, default None
+            Cache für bereits geparste DynaLog-Dateien.
+
+        compact : boolean, default False
+            Speichert die Spalten als kleinstmöglichen Integer-Typ.
+
+        workers : int, default None
+            Anzahl der Prozesse, auf die das Parsen verteilt wird (nicht bei
+            header_only). Mit cache legen die Prozesse ihre Ergebnisse im Cache
+            ab und der aufrufende Prozess öffnet sie per Memory-Mapping, statt
+            die Arrays zwischen den Prozessen zu pickeln.
+
+        archives : boolean, default True
+            Liest auch .dlg.gz, .dlg.xz und .dlg-Dateien in zip-Archiven.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict
+            Listen von leafbank_dynalog-Objekten, sortiert nach mode.
+        """
+        banks = self.load_banks(self.find_files(top,"dlg",archives),
+            header_only,cache,compact,workers)
+        return self.group_banks(banks,mode)
+
+    @classmethod
+    def load_banks(self,files,header_only=False,cache=None,compact=False,
+        workers=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        files : list of tuple
+            (Pfad, Dateiname) wie von find_files geliefert.
+
+        header_only, cache, compact, workers :
+            Siehe get_banks.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of leafbank_dynalog objects
+            In der Reihenfolge von files.
+        """
+        if workers == None or workers <= 1 or header_only == True:
+            return [leafbank_dynalog(filename,f[0],self.bank_columns,
+                header_only,cache,compact) for filename,f in files]
+        pool = multiprocessing.Pool(workers)
+        try:
+            banks = pool.map(_ingest_bank,[(filename,f[0],self.bank_columns,
+                cache,compact) for filename,f in files],chunksize=4)
+        finally:
+            pool.close()
+            pool.join()
+        if cache != None:
+            banks = [leafbank_dynalog(filename,f[0],self.bank_columns,
+                cache=cache,compact=compact) for filename,f in files]
+        return banks
+
+    @classmethod
+    def group_banks(self,banks,mode="plan_uid"):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        banks : list of leafbank_dynalog objects
+
+        mode : str, default "plan_uid"
+            "plan_uid", "patient_id" oder "patient_name".
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict
+            Listen von Leafbänken, sortiert nach mode.
+        """
+        return bank_groups(banks).groups.get(str(mode),{})
+
+class bank_groups:
+
+    modes = ["plan_uid","patient_id","patient_name","beam"]
+
+    timestamp_pattern = re.compile(r"(\d{14})")
+    #Varian-Dateinamen enthalten den Zeitpunkt als YYYYMMDDhhmmss.
+
+    def __init__(self,banks=None,session_gap=3600):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        banks : list of leafbank_dynalog objects, default None
+            Leafbänke, die sofort einsortiert werden.
+
+        session_gap : float, default 3600
+            Zeit in Sekunden zwischen zwei Leafbänken eines Plans, ab der eine
+            neue Bestrahlung (Fraktion) angenommen wird.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        key :
+            Gruppenschlüssel einer Leafbank für einen Modus.
+
+        add :
+            Sortiert Leafbänke in alle Gruppierungen ein.
+
+        remove :
+            Entfernt Leafbänke aus allen Gruppierungen.
+
+        timestamp :
+            Aufnahmezeitpunkt einer Leafbank.
+
+        assign_deliveries :
+            Teilt die Leafbänke eines Plans in einzelne Bestrahlungen auf.
+
+        deliveries :
+            Liefert die Leafbänke eines Plans je Bestrahlung.
+
+        Instanzvariablen
+        -----------------------------------------------------------------------
+        groups : dict
+            Für jeden Modus aus modes ein Dictionary Schlüssel -> Liste von
+            Leafbänken. "beam" gruppiert nach (plan_uid, beam_number, side).
+            Zusätzlich gruppiert "delivery" nach (plan_uid, Bestrahlung,
+            beam_number, side), Bestrahlungen werden ab 1 gezählt.
+
+        delivery_keys : dict
+            plan_uid -> Liste der Schlüssel dieses Plans in groups["delivery"],
+            damit ein Plan nicht alle Bestrahlungen durchsuchen muss.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Sortiert jede Leafbank in einem Durchgang per Hash in alle
+        Gruppierungen gleichzeitig ein. Ein Wechsel des Modus erfordert damit
+        keine neue Gruppierung, und hinzukommende oder gelöschte Dateien
+        ändern nur die betroffenen Gruppen.
+
+        Da ein Plan meist in vielen Fraktionen bestrahlt wird, enthält die
+        plan_uid-Gruppe oft mehr als 2*Arcs Leafbänke. Die Gruppierung
+        "delivery" trennt diese anhand der Aufnahmezeit wieder in einzelne,
+        unabhängig rekonstruierbare Bestrahlungen.
+        """
+        self.session_gap = session_gap
+        self.groups = dict([(mode,{}) for mode in self.modes + ["delivery"]])
+        self.delivery_keys = {}
+        self.times = {}
+        if banks != None:
+            self.add(banks)
+
+    @classmethod
+    def key(self,bank,mode):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : str or tuple
+            Schlüssel der Leafbank im Modus mode. Patientennamen werden wie
+            bisher kommagetrennt zusammengefügt.
+        """
+        if mode == "patient_name":
+            return ",".join(bank.header["patient_name"])
+        elif mode == "beam":
+            return (bank.header["plan_uid"],bank.header["beam_number"],
+                bank.header["side"])
+        return bank.header[mode]
+
+    def add(self,banks):
+        for bank in banks:
+            for mode in self.modes:
+                self.groups[mode].setdefault(self.key(bank,mode),[]).append(bank)
+        self.assign_deliveries(set([bank.header["plan_uid"] for bank in banks]))
+
+    def remove(self,banks):
+        for bank in banks:
+            for mode in self.modes:
+                key = self.key(bank,mode)
+                group = self.groups[mode][key]
+                group.remove(bank)
+                if len(group) == 0:
+                    del self.groups[mode][key]
+            self.times.pop(id(bank),None)
+        self.assign_deliveries(set([bank.header["plan_uid"] for bank in banks]))
+
+    def timestamp(self,bank):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : float
+            Aufnahmezeitpunkt der Leafbank in Sekunden seit der Epoche. Wird
+            aus dem Dateinamen gelesen (YYYYMMDDhhmmss), sonst wird die
+            Änderungszeit der Datei verwendet.
+        """
+        if id(bank) not in self.times:
+            match = self.timestamp_pattern.search(os.path.basename(
+                bank.header["filename"].replace("\\","/")))
+            try:
+                self.times[id(bank)] = time.mktime(time.strptime(
+                    match.group(1),"%Y%m%d%H%M%S"))
+            except (AttributeError,ValueError):
+                self.times[id(bank)] = filetools.identity(bank.header["filename"])[2]
+        return self.times[id(bank)]
+
+    def assign_deliveries(self,plan_uids):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        plan_uids : iterable of str
+            Pläne, deren Bestrahlungen neu bestimmt werden.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Sortiert die Leafbänke jedes Plans nach Aufnahmezeit. Eine neue
+        Bestrahlung beginnt, sobald eine Kombination aus Beamnummer und Seite
+        in der laufenden Bestrahlung schon vorkam oder seit der letzten
+        Leafbank mehr als session_gap Sekunden vergangen sind.
+        """
+        delivery_groups = self.groups["delivery"]
+        for uid in plan_uids:
+            for key in self.delivery_keys.pop(uid,[]):
+                del delivery_groups[key]
+            keys = []
+            banks = sorted(self.groups["plan_uid"].get(uid,[]),
+                key=lambda bank: (self.timestamp(bank),bank.header["filename"]))
+            delivery = 0
+            seen = set()
+            last = None
+            for bank in banks:
+                beam = (bank.header["beam_number"],bank.header["side"])
+                if delivery == 0 or beam in seen or\
+                    self.timestamp(bank) - last > self.session_gap:
+                    delivery += 1
+                    seen = set()
+                seen.add(beam)
+                last = self.timestamp(bank)
+                key = (uid,delivery)+beam
+                if key not in delivery_groups:
+                    delivery_groups[key] = []
+                    keys.append(key)
+                delivery_groups[key].append(bank)
+            if len(keys) > 0:
+                self.delivery_keys[uid] = keys
+
+    def deliveries(self,plan_uid,bank_count=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        plan_uid : str
+
+        bank_count : int, default None
+            Falls angegeben, werden nur Bestrahlungen mit genau so vielen
+            Leafbänken (2*Arcs für vollständige Bestrahlungen) geliefert.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of list
+            Je Bestrahlung die Liste ihrer Leafbänke, zeitlich sortiert. Kann
+            direkt an plan.construct_logbeams übergeben werden.
+        """
         output = {}
-        if mode == "plan_uid":
-            uids = list(set([p.header["plan_uid"] for p in banks]))
-            for uid in uids:
-                output[uid] = list(np.array(banks)[np.where(np.array(
-                [b.header["plan_uid"] for b in banks])==uid)[0]])
-        elif mode == "patient_id":
-            pids = list(set([p.header["patient_id"] for p in banks]))
-            for pid in pids:
-                output[pid] = list(np.array(banks)[np.where(np.array(\
-                [b.header["patient_id"] for b in banks])==pid)[0]])
-        elif mode == "patient_name":
-            names = list(set([",".join(p.header["patient_name"]) for p in banks]))
-            for name in names:
-                output[name] = [bank for bank in banks if\
-                    bank.header["patient_name"] == name.split(",")]
-        return output
+        for key in self.delivery_keys.get(plan_uid,[]):
+            output.setdefault(key[1],[]).extend(self.groups["delivery"][key])
+        return [output[num] for num in sorted(output.keys())
+            if bank_count == None or len(output[num]) == bank_count]
 
 
 class leafbank_dynalog:
 
-    def __init__(self,filename,side=None):
+    column_index = {"dose_fraction":0,"previous_segment":1,"beam_holdoff":2,
+        "beam_on":3,"gantry_angle":6,"collimator_rotation":7,"y1":8,"y2":9,
+        "x1":10,"x2":11,"carriage_expected":12,"carriage_actual":13,
+        "leafs_expected":slice(14,None,4),"leafs_actual":slice(15,None,4)}
+    #Spalten des Datenteils, über die Instanzvariablen angesprochen werden.
+
+    column_groups = {"dose":["dose_fraction"],"gantry":["gantry_angle"],
+        "segment":["previous_segment"],
+        "leafs":["leafs_expected","leafs_actual"],
+        "jaws":["y1","y2","x1","x2"],
+        "carriage":["carriage_expected","carriage_actual"]}
+
+    def __init__(self,filename,side=None,columns=None,header_only=False,
+        cache=None,compact=False,header=None):
         """
         Parameter
         -----------------------------------------------------------------------
@@ -60,12 +610,42 @@ class leafbank_dynalog:
             Dateinamens wird als Bezeichnung der Leafbank (in der Regel A oder B)
             verwendet.
 
+        columns : list of str, default None
+            Spalten, die beim Einlesen tatsächlich übernommen werden. Möglich
+            sind alle Schlüssel aus column_index sowie die Gruppen aus
+            column_groups (z.B. "jaws" oder "carriage"). Alle anderen Spalten
+            werden erst beim ersten Zugriff auf die Instanzvariable aus der
+            Datei nachgeladen, raw_data wird dann nicht vorgehalten. Bei None
+            wird wie bisher der komplette Datenteil in raw_data gespeichert.
+
+        header_only : boolean, default False
+            Liest nur die 6 Headerzeilen. Der Datenteil wird erst beim ersten
+            Zugriff auf eine Spalte eingelesen, dann gemäß columns.
+
+        cache : dynalog_cache, default None
+            Falls angegeben, wird der Datenteil aus dem Cache gelesen bzw. nach
+            dem Parsen dort abgelegt.
+
+        compact : boolean, default False
+            Alle Werte im DynaLog sind Ganzzahlen (Leafpositionen in 1/100 mm,
+            Dosis 0-25000, Winkel in 1/10 Grad). Bei True wird jede Spalte als
+            kleinstmöglicher Integer-Typ (int16 oder int32) gespeichert statt
+            als float64. Umrechnung in float erfolgt erst in beam.convert_mlc
+            und stats().
+
+        header : dict, default None
+            Bereits bekannter Header, z.B. aus einem log_index. Zusammen mit
+            header_only wird die Datei beim Erstellen dann gar nicht geöffnet.
+
         Funktionen
         -----------------------------------------------------------------------
         read_data :
             Liest Textdokument ein, trennt Header ab, ruft weitere Funktionen
             auf
 
+        read_header :
+            Liest nur die Headerzeilen ein.
+
         build_header :
             Überträgt die Informationen aus dem Header in Objekteigenschaften.
 
@@ -78,6 +658,18 @@ class leafbank_dynalog:
         build_mlc :
             Importiert die Leafpositionen.
 
+        load_columns :
+            Lädt einzelne Spalten nachträglich aus der Datei.
+
+        convert_raw :
+            Wandelt den kompletten Datenteil ggf. in float.
+
+        iter_blocks :
+            Liefert den Datenteil blockweise, für beliebig lange Logs.
+
+        stream_stats :
+            Minimum, Maximum und Mittel der Leafabweichung über iter_blocks.
+
         Instanzvariablen
         -----------------------------------------------------------------------
         header : dict
@@ -127,6 +719,7 @@ class leafbank_dynalog:
         Stellt die Informationen im DynaLog-File bequem zur Verfügung. Die
         Informationen der Headerzeilen werden komplett übernommen, die Spalten
         des Datenteils entweder verworfen oder in Numpy-Arrays eingelesen.
+        Nicht eingelesene Spalten werden beim ersten Zugriff nachgeladen.
         """
         self.header = {}
         self.header["filename"] = filename
@@ -136,113 +729,466 @@ class leafbank_dynalog:
         else:
             self.header["side"] = side
 
-        self.read_data()
+        self.columns = self.expand_columns(columns)
+        self.cache = cache
+        self.compact = compact
+        self.loaded = False
+        if header_only == True and header != None:
+            self.header.update([(key,value) for key,value in header.items()
+                if key not in ["filename","side"]])
+        elif header_only == True:
+            self.read_header()
+        else:
+            self.read_data()
+
+    def __getattr__(self,name):
+        """
+        Wird nur aufgerufen, wenn die Instanzvariable noch nicht existiert.
+        Spalten aus column_index und raw_data werden dann nachgeladen. Wurde
+        bisher nur der Header gelesen, wird zunächst read_data ausgeführt, das
+        die angefragte Spalte gleich mit übernimmt.
+        """
+        if "header" not in self.__dict__ or (name != "raw_data" and
+            name not in self.column_index):
+            raise AttributeError(name)
+        if self.__dict__.get("loaded") == False:
+            self.read_data([name])
+        if name not in self.__dict__:
+            self.load_columns([name])
+        return self.__dict__[name]
+
+    @classmethod
+    def expand_columns(self,columns):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        columns : list of str or None
+            Spaltennamen und/oder Gruppennamen aus column_groups.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Löst Gruppennamen in die einzelnen Spalten auf und prüft, ob alle
+        Namen bekannt sind.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of str or None
+        """
+        if columns == None:
+            return None
+        output = []
+        for name in columns:
+            for column in self.column_groups.get(name,[name]):
+                if column not in self.column_index:
+                    raise KeyError("unknown DynaLog column: {0}".format(column))
+                if column not in output:
+                    output.append(column)
+        return output
 
-    def read_data(self):
+    def read_data(self,extra=[]):
         """
+        Parameter
+        -----------------------------------------------------------------------
+        extra : list of str, default []
+            Weitere Spalten (oder "raw_data"), die zusätzlich zur beim
+            Erstellen übergebenen Auswahl aus demselben Datenteil übernommen
+            werden.
+
         Beschreibung
         -----------------------------------------------------------------------
         Öffnet die Dynalog-Datei, teilt den Header zur weiteren Verarbeitung ab,
         wandelt den Datenteil in ein Numpy-Array mit float-Zahlen und ruft
         Funktionen zur weiteren Verarbeitung auf. Nimmt eine Headerlänge von
         6 Zeilen an.
-        """
-        with open(self.header["filename"],"r") as data:
-            raw = [line.strip().split(",") for line in data.readlines()]
 
-            self.build_header(raw[:6])
+        Falls beim Erstellen eine Spaltenauswahl übergeben wurde, werden nur
+        diese Spalten übernommen und das Gesamtarray wieder verworfen.
+        """
+        raw_data = self.read_raw()
+        self.loaded = True
 
-            self.raw_data = np.array(raw[6:]).astype(float)
+        if self.columns == None:
+            self.raw_data = self.convert_raw(raw_data)
             self.build_beam(self.raw_data)
             self.build_gantry(self.raw_data)
             self.build_mlc(self.raw_data)
+        else:
+            self.project_columns(raw_data,self.columns)
+            missing = [column for column in extra if column not in self.__dict__]
+            if len(missing) > 0:
+                self.load_columns(missing,raw_data)
 
-    def build_header(self,raw_header):
+    def read_raw(self):
         """
-        Parameter
+        Beschreibung
         -----------------------------------------------------------------------
-        raw_header : list, [[str,str],...]
-            Enthält die Wertepaare der Kopfzeile als Liste.
+        Liefert Header und kompletten Datenteil. Ist ein dynalog_cache
+        angegeben, wird bei einem Treffer das gespeicherte Array per
+        Memory-Mapping geöffnet und das Textdokument gar nicht gelesen. Bei
+        einem Fehlschlag wird die Datei geparst und im Cache abgelegt.
 
-        Beschreibung
+        Der Datenteil wird nicht umgewandelt, ein Cache-Treffer bleibt also
+        ein Integer-memmap. Erst beim Übernehmen werden die tatsächlich
+        verwendeten Spalten kopiert und ggf. in float gewandelt, siehe
+        project_columns und convert_raw.
+
+        Ausgabe
         -----------------------------------------------------------------------
-        Erweitert das header-Dictionary um die Einträge aus den Kopfzeilen des
-        DynaLog-Files.
+        output : ndarray
+            Datenteil des DynaLog-Files.
         """
-        self.header["version"] = raw_header[0][0]
-        self.header["patient_id"] = raw_header[1][-1]
-        self.header["plan_uid"] = raw_header[2][0]
-        self.header["beam_number"] = int(raw_header[2][1])
-        self.header["tolerance"] = int(raw_header[3][0])
-        self.header["leaf_count"] = int(raw_header[4][0])
-        self.header["coord_system"] = int(raw_header[5][0])
+        raw_data = None
+        if self.cache != None:
+            hit = self.cache.load(self.header["filename"])
+            if hit != None:
+                self.header.update(hit[0])
+                raw_data = hit[1]
 
-        name = raw_header[1][:-1]
-        if len(name) == 1:
-            name.append("N/A")
-        if "" in name:
-            name = [n if n != "" else "N/A" for n in name]
-        self.header["patient_name"] = name
+        if raw_data is None:
+            with filetools.open_file(self.header["filename"]) as data:
+                self.build_header([data.readline().strip().split(",")
+                    for num in range(6)])
+                raw_data = self.parse_data(data.read(),
+                    self.compact or self.cache != None)
+            if self.cache != None:
+                self.cache.store(self.header["filename"],self.header,raw_data)
+                #Cache enthält immer die kompakte Form.
+        return raw_data
 
-    def build_gantry(self,raw_data):
+    def convert_raw(self,raw_data):
         """
-        Parameter
+        Ausgabe
         -----------------------------------------------------------------------
-        raw_data : ndarray
-            Enthält die Daten des DynaLog-Files als Array.
+        output : ndarray
+            Kompletter Datenteil als raw_data. Ohne compact wird er in float
+            gewandelt (dafür ist eine vollständige Kopie nötig), sonst bleibt
+            er unverändert, bei Cache-Treffern also memory-mapped.
+        """
+        if self.compact == False and raw_data.dtype.kind == "i":
+            return np.array(raw_data,dtype=float)
+        return raw_data
 
+    def read_header(self):
+        """
         Beschreibung
         -----------------------------------------------------------------------
-        Extrahiert die Werte der Gantry-bezogenen Parameter Winkel, Segment,
-        Kollimator-Rotation und Jaw-Positionen.
+        Liest nur die 6 Headerzeilen der DynaLog-Datei, der Datenteil bleibt
+        ungelesen. Reicht aus, um Leafbänke nach Plan oder Patient zu
+        gruppieren.
         """
-        self.gantry_angle = raw_data[:,6]
-#        self.previous_segment = raw_data[:,1]
-#        self.collimator_rotation = raw_data[:,7]
-#        self.y1 = raw_data[:,8]
-#        self.y2 = raw_data[:,9]
-#        self.x1 = raw_data[:,10]
-#        self.x2 = raw_data[:,11]
-        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
+        with filetools.open_file(self.header["filename"]) as data:
+            self.build_header([data.readline().strip().split(",")
+                for num in range(6)])
 
-    def build_beam(self,raw_data):
+    def project_columns(self,raw_data,columns):
         """
         Parameter
         -----------------------------------------------------------------------
         raw_data : ndarray
-            Enthält die Daten des DynaLog-Files als Array.
+            Kompletter Datenteil des DynaLog-Files.
+
+        columns : list of str
+            Schlüssel aus column_index.
 
         Beschreibung
         -----------------------------------------------------------------------
-        Extrahiert Beamdaten wie kumulative Dosisfraktion und Einschaltstatus.
+        Kopiert die gewünschten Spalten in eigene, zusammenhängende Arrays,
+        damit raw_data anschließend freigegeben werden kann. Im compact-Modus
+        erhält jede Spalte ihren eigenen, kleinstmöglichen Integer-Typ, sonst
+        wird nur die Spalte selbst in float gewandelt. Bei einem memory-mapped
+        raw_data werden so nur die Seiten dieser Spalten gelesen.
         """
-        self.dose_fraction = raw_data[:,0]
-#        self.beam_holdoff = raw_data[:,2]
-#        self.beam_on = raw_data[:,3]
-        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
+        for column in columns:
+            data = raw_data[:,self.column_index[column]]
+            if self.compact == True:
+                data = self.compact_array(np.array(data))
+            else:
+                data = data.astype(float)
+            setattr(self,column,data)
 
-    def build_mlc(self,raw_data):
+    def load_columns(self,columns,raw_data=None):
         """
         Parameter
         -----------------------------------------------------------------------
-        raw_data : ndarray
-            Enthält die Daten des DynaLog-Files als Array.
+        columns : list of str
+            Schlüssel aus column_index, oder "raw_data" für den kompletten
+            Datenteil.
+
+        raw_data : ndarray, default None
+            Bereits gelesener Datenteil, siehe read_data.
 
         Beschreibung
         -----------------------------------------------------------------------
-        Extrahiert die eigentlich spannenden Daten zu Carriage- und Leafposition,
-        Soll- und Ist-Zustand.
+        Lädt Spalten, die beim Einlesen nicht ausgewählt waren. Ist raw_data
+        vorhanden, wird nur eine View darauf erzeugt, ansonsten wird der
+        Datenteil erneut gelesen. Musste dafür die Textdatei geparst werden
+        (kein memory-mapped Cache-Eintrag), werden alle noch fehlenden Spalten
+        auf einmal übernommen, damit jede Datei höchstens ein weiteres Mal
+        geparst wird.
         """
-#        self.carriage_expected = raw_data[:,12]
-#        self.carriage_actual = raw_data[:,13]
-        self.leafs_expected = raw_data[:,14::4]
-        self.leafs_actual = raw_data[:,15::4]
+        if "raw_data" in self.__dict__:
+            for column in columns:
+                if column != "raw_data":
+                    setattr(self,column,self.raw_data[:,self.column_index[column]])
+            return None
 
-    def stats(self):
-        self.leafdifference = self.leafs_actual - self.leafs_expected
-#        self.leafdifference_min = np.min(self.leafdifference,axis=0)
-#        self.leafdifference_max = np.max(self.leafdifference,axis=0)
-#        self.leafdifference_mean = np.mean(self.leafdifference,axis=0)
+        if raw_data is None:
+            raw_data = self.read_raw()
+        if not isinstance(raw_data,np.memmap):
+            columns = list(columns) + [column for column in
+                self.column_index.keys() if column not in self.__dict__
+                and column not in columns]
+
+        if "raw_data" in columns:
+            self.raw_data = self.convert_raw(raw_data)
+            columns = [column for column in columns if column != "raw_data"]
+        self.project_columns(raw_data,columns)
+
+    @classmethod
+    def compact_array(self,data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        data : ndarray
+            Array mit ganzzahligen Werten.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Wandelt das Array in den kleinsten Integer-Typ (int16 oder int32) um,
+        der alle Werte aufnehmen kann. Arrays mit Nachkommastellen oder zu
+        großen Werten werden unverändert zurückgegeben.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+        """
+        if data.size == 0:
+            return data.astype(np.int16)
+        if data.dtype.kind == "f" and not np.all(np.mod(data,1) == 0):
+            return data
+        low,high = data.min(),data.max()
+        for dtype in [np.int16,np.int32]:
+            if low >= np.iinfo(dtype).min and high <= np.iinfo(dtype).max:
+                return data.astype(dtype)
+        return data
+
+    @classmethod
+    def parse_data(self,text,compact=False):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        text : str
+            Datenteil des DynaLog-Files (alles nach den 6 Headerzeilen).
+
+        compact : boolean, default False
+            Gibt das Array im kleinstmöglichen Integer-Typ statt als float
+            zurück (siehe compact_array).
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Wandelt den kommagetrennten Datenteil in einem Durchgang direkt in ein
+        float-Array um. Im Gegensatz zu np.array(...).astype(float) auf den
+        gesplitteten Zeilen entsteht dabei keine Zwischenmatrix aus Strings,
+        numpy schreibt die Werte sofort in das Ergebnisarray. Die Spaltenzahl
+        wird aus der ersten Datenzeile bestimmt.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Dimension (Zeilen,Spalten) des Datenteils.
+        """
+        text = text.lstrip()
+        if text == "":
+            return np.zeros((0,0),dtype=np.int16 if compact else float)
+        end = text.find("\n")
+        columns = (text if end == -1 else text[:end]).count(",") + 1
+        text = text.replace(","," ")
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            try:
+                values = np.fromstring(text,dtype=np.int64,sep=" ")
+                values = self.compact_array(values) if compact\
+                    else values.astype(float)
+            except (ValueError,DeprecationWarning):
+                values = np.fromstring(text,dtype=float,sep=" ")
+            #DynaLogs enthalten nur Ganzzahlen, deren Parser ist ca. 3x
+            #schneller als der für floats. Fallback für Dateien mit Dezimalzahlen.
+        if values.size % columns != 0:
+            raise ValueError("DynaLog data section is not rectangular: "\
+                "{0} values for {1} columns".format(values.size,columns))
+        return values.reshape((-1,columns))
+
+    def build_header(self,raw_header):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        raw_header : list, [[str,str],...]
+            Enthält die Wertepaare der Kopfzeile als Liste.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Erweitert das header-Dictionary um die Einträge aus den Kopfzeilen des
+        DynaLog-Files.
+        """
+        self.header["version"] = raw_header[0][0]
+        self.header["patient_id"] = raw_header[1][-1]
+        self.header["plan_uid"] = raw_header[2][0]
+        self.header["beam_number"] = int(raw_header[2][1])
+        self.header["tolerance"] = int(raw_header[3][0])
+        self.header["leaf_count"] = int(raw_header[4][0])
+        self.header["coord_system"] = int(raw_header[5][0])
+
+        name = raw_header[1][:-1]
+        if len(name) == 1:
+            name.append("N/A")
+        if "" in name:
+            name = [n if n != "" else "N/A" for n in name]
+        self.header["patient_name"] = name
+
+    def build_gantry(self,raw_data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        raw_data : ndarray
+            Enthält die Daten des DynaLog-Files als Array.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Extrahiert die Werte der Gantry-bezogenen Parameter Winkel, Segment,
+        Kollimator-Rotation und Jaw-Positionen.
+        """
+        self.gantry_angle = raw_data[:,6]
+#        self.previous_segment = raw_data[:,1]
+#        self.collimator_rotation = raw_data[:,7]
+#        self.y1 = raw_data[:,8]
+#        self.y2 = raw_data[:,9]
+#        self.x1 = raw_data[:,10]
+#        self.x2 = raw_data[:,11]
+        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
+        #Werden beim ersten Zugriff über __getattr__ nachgeladen.
+
+    def build_beam(self,raw_data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        raw_data : ndarray
+            Enthält die Daten des DynaLog-Files als Array.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Extrahiert Beamdaten wie kumulative Dosisfraktion und Einschaltstatus.
+        """
+        self.dose_fraction = raw_data[:,0]
+#        self.beam_holdoff = raw_data[:,2]
+#        self.beam_on = raw_data[:,3]
+        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
+        #Werden beim ersten Zugriff über __getattr__ nachgeladen.
+
+    def build_mlc(self,raw_data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        raw_data : ndarray
+            Enthält die Daten des DynaLog-Files als Array.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Extrahiert die eigentlich spannenden Daten zu Carriage- und Leafposition,
+        Soll- und Ist-Zustand.
+        """
+#        self.carriage_expected = raw_data[:,12]
+#        self.carriage_actual = raw_data[:,13]
+        #Werden beim ersten Zugriff über __getattr__ nachgeladen.
+        self.leafs_expected = raw_data[:,14::4]
+        self.leafs_actual = raw_data[:,15::4]
+
+    def stats(self):
+        self.leafdifference = self.leafs_actual.astype(float) - self.leafs_expected
+#        self.leafdifference_min = np.min(self.leafdifference,axis=0)
+#        self.leafdifference_max = np.max(self.leafdifference,axis=0)
+#        self.leafdifference_mean = np.mean(self.leafdifference,axis=0)
+
+    def iter_blocks(self,rows=10000):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        rows : int, default 10000
+            Anzahl der Zeilen pro Block.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Generator, der den Datenteil blockweise liefert, ohne ihn komplett
+        einzulesen. Der Speicherbedarf hängt so nur von rows ab, nicht von der
+        Länge des Logs. Liegt die Datei im Cache, werden die Blöcke aus dem
+        memory-mapped Array geschnitten, ansonsten wird die Textdatei
+        zeilenweise weitergelesen. Spalten lassen sich wie bei raw_data über
+        column_index auswählen.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Je Block ein Array der Dimension (<=rows,Spalten).
+        """
+        hit = None
+        if self.cache != None:
+            hit = self.cache.load(self.header["filename"])
+        if hit != None:
+            for start in range(0,hit[1].shape[0],rows):
+                block = np.array(hit[1][start:start+rows])
+                if self.compact == False:
+                    block = block.astype(float)
+                yield block
+            return
+
+        with filetools.open_file(self.header["filename"]) as data:
+            for num in range(6):
+                data.readline()
+            while True:
+                text = "".join(itertools.islice(data,rows))
+                if text.strip() == "":
+                    break
+                yield self.parse_data(text,self.compact)
+
+    def stream_stats(self,rows=10000,tolerance=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        rows : int, default 10000
+            Blockgröße für iter_blocks.
+
+        tolerance : float, default None
+            Grenzwert für |Ist - Soll| in DynaLog-Einheiten (1/100 mm). Falls
+            angegeben, wird je Leaf gezählt, wie oft er überschritten wird.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Wie stats(), berechnet aber Minimum, Maximum und Mittelwert der
+        Leafabweichung blockweise über einen leaf_statistics-Akkumulator, ohne
+        leafdifference für das ganze Log anzulegen. Ergebnisse landen in
+        leafdifference_min, _max, _mean und ggf. leafdifference_exceeded, die
+        Zahl der Datenpunkte in leafdifference_count und der Akkumulator
+        selbst in leafdifference_statistics.
+        """
+        statistics = leaf_statistics()
+        exceeded = None
+        for block in self.iter_blocks(rows):
+            difference = block[:,self.column_index["leafs_actual"]].astype(float)
+            difference -= block[:,self.column_index["leafs_expected"]]
+            statistics.add(difference)
+            if tolerance != None:
+                if exceeded is None:
+                    exceeded = np.zeros(difference.shape[1],dtype=int)
+                exceeded += np.sum(np.abs(difference) > tolerance,axis=0)
+
+        if statistics.count == 0:
+            raise ValueError("no data in {0}".format(self.header["filename"]))
+        self.leafdifference_statistics = statistics
+        self.leafdifference_count = statistics.count
+        self.leafdifference_min = statistics.minimum
+        self.leafdifference_max = statistics.maximum
+        self.leafdifference_mean = statistics.mean
+        if tolerance != None:
+            self.leafdifference_exceeded = exceeded
 
     def write(self,filename=None):
         header = []
@@ -262,3 +1208,836 @@ class leafbank_dynalog:
             np.savetxt(filename,self.raw_data.astype(int),delimiter=",",header="\n".join(header),comments="",fmt="%i")
 
 
+
+
+class leaf_statistics:
+
+    histogram_edges = np.arange(-200,201,10)
+    fields = ["sum","sum_squares","minimum","maximum","mean","m2","histogram"]
+
+    def __init__(self,edges=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        edges : array_like, default None
+            Klassengrenzen des Histogramms in DynaLog-Einheiten (1/100 mm).
+            None für histogram_edges, -2 mm bis 2 mm in Schritten von 0.1 mm.
+            Nur Akkumulatoren mit gleichen Grenzen lassen sich vereinigen.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        add :
+            Nimmt einen Block Leafabweichungen auf.
+
+        add_bank :
+            Nimmt alle Leafabweichungen einer Leafbank blockweise auf.
+
+        merge :
+            Vereinigt ein zweites Teilergebnis mit diesem.
+
+        variance, std, rms :
+            Varianz, Standardabweichung und Effektivwert je Leaf.
+
+        to_arrays, from_arrays :
+            Wandelt den Akkumulator in ein Dictionary von Arrays und zurück,
+            z.B. zum Speichern im log_index.
+
+        Instanzvariablen
+        -----------------------------------------------------------------------
+        count : int
+            Anzahl der aufgenommenen Datenpunkte (Zeilen) je Leaf.
+
+        sum, sum_squares, minimum, maximum, mean, m2 : ndarray
+            Je Leaf Summe, Quadratsumme, Minimum, Maximum, Mittelwert und
+            Summe der quadrierten Abweichungen vom Mittelwert (Welford).
+            None, solange noch keine Daten aufgenommen wurden.
+
+        histogram : ndarray
+            Häufigkeiten der Dimension (Leafs,len(edges)+1). Klasse k enthält
+            edges[k-1] <= x < edges[k], die erste und letzte Klasse alle Werte
+            unter- bzw. oberhalb der Grenzen.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Zusammenführbarer Akkumulator für die Statistik der Leafabweichungen.
+        Der Speicherbedarf hängt nur von der Zahl der Leafs ab, nicht von der
+        Zahl oder Länge der Logs. Teilergebnisse, z.B. je Leafbank oder je
+        Prozess, lassen sich in beliebiger Reihenfolge mit merge vereinigen;
+        Mittelwert und m2 werden dabei nach Chan et al. kombiniert, was
+        numerisch stabiler ist als die Varianz aus sum und sum_squares.
+        """
+        if edges is None:
+            edges = self.histogram_edges
+        self.edges = np.asarray(edges,dtype=float)
+        self.count = 0
+        for name in self.fields:
+            setattr(self,name,None)
+
+    def add(self,difference):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        difference : ndarray
+            Leafabweichungen der Dimension (Zeilen,Leafs).
+        """
+        difference = np.asarray(difference,dtype=float)
+        if difference.shape[0] == 0:
+            return self
+        block = leaf_statistics(self.edges)
+        block.count = difference.shape[0]
+        block.sum = difference.sum(axis=0)
+        block.sum_squares = np.einsum("ij,ij->j",difference,difference)
+        block.minimum = difference.min(axis=0)
+        block.maximum = difference.max(axis=0)
+        block.mean = block.sum/block.count
+        centered = difference - block.mean
+        block.m2 = np.einsum("ij,ij->j",centered,centered)
+        bins = len(self.edges)+1
+        position = np.searchsorted(self.edges,difference,side="right")
+        position += np.arange(difference.shape[1])*bins
+        block.histogram = np.bincount(position.ravel(),
+            minlength=difference.shape[1]*bins).reshape(-1,bins)
+        #Eine Bincount-Zählung für alle Leafs, jedes Leaf hat eigene Klassen.
+        return self.merge(block)
+
+    def add_bank(self,bank,rows=10000):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        bank : leafbank_dynalog
+            Auch mit header_only, die Daten werden über iter_blocks gelesen.
+
+        rows : int, default 10000
+            Blockgröße für iter_blocks.
+        """
+        for block in bank.iter_blocks(rows):
+            difference = block[:,bank.column_index["leafs_actual"]].astype(float)
+            difference -= block[:,bank.column_index["leafs_expected"]]
+            self.add(difference)
+        return self
+
+    def merge(self,other):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        other : leaf_statistics
+            Teilergebnis mit derselben Leafzahl, bleibt unverändert.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : leaf_statistics
+            self, mit other vereinigt.
+        """
+        if not np.array_equal(self.edges,other.edges):
+            raise ValueError("histogram edges differ")
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            for name in self.fields:
+                setattr(self,name,getattr(other,name).copy())
+            return self
+        if self.mean.shape != other.mean.shape:
+            raise ValueError("leaf count mismatch: {0} and {1}".format(
+                self.mean.shape[0],other.mean.shape[0]))
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2*(float(self.count)*other.count/count)
+        self.mean += delta*(float(other.count)/count)
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        np.minimum(self.minimum,other.minimum,out=self.minimum)
+        np.maximum(self.maximum,other.maximum,out=self.maximum)
+        self.histogram += other.histogram
+        self.count = count
+        return self
+
+    def variance(self,ddof=0):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Varianz je Leaf, mit ddof=1 die Stichprobenvarianz.
+        """
+        if self.count <= ddof:
+            raise ValueError("not enough data points for variance")
+        return self.m2/(self.count-ddof)
+
+    def std(self,ddof=0):
+        return np.sqrt(self.variance(ddof))
+
+    def rms(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Effektivwert (Wurzel des mittleren Quadrats) je Leaf.
+        """
+        if self.count == 0:
+            raise ValueError("no data points")
+        return np.sqrt(self.sum_squares/self.count)
+
+    def to_arrays(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict
+            Alle Instanzvariablen als Arrays, für np.savez geeignet. Leere
+            Akkumulatoren haben nur count und edges.
+        """
+        arrays = {"count":np.array(self.count),"edges":self.edges}
+        if self.count > 0:
+            for name in self.fields:
+                arrays[name] = getattr(self,name)
+        return arrays
+
+    @classmethod
+    def from_arrays(self,arrays):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        arrays : dict or NpzFile
+            Ergebnis von to_arrays.
+        """
+        statistics = leaf_statistics(arrays["edges"])
+        statistics.count = int(arrays["count"])
+        if statistics.count > 0:
+            for name in self.fields:
+                setattr(statistics,name,np.array(arrays[name]))
+        return statistics
+
+class dynalog_cache:
+
+    def __init__(self,directory,max_size=2*1024**3):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        directory : str
+            Verzeichnis, in dem die Cache-Einträge abgelegt werden. Wird bei
+            Bedarf angelegt.
+
+        max_size : int, default 2 GB
+            Maximale Größe des Caches in Byte. Wird sie überschritten, werden
+            die am längsten nicht mehr verwendeten Einträge gelöscht.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        key :
+            Erzeugt den Schlüssel einer Datei aus Pfad, Größe und Änderungszeit.
+
+        load :
+            Öffnet einen vorhandenen Eintrag per Memory-Mapping.
+
+        store :
+            Legt Header und Datenteil einer DynaLog-Datei im Cache ab.
+
+        evict :
+            Löscht alte Einträge, bis max_size eingehalten wird.
+
+        invalidate :
+            Löscht einzelne oder alle Einträge.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Persistenter Cache für bereits geparste DynaLog-Dateien. Jeder Eintrag
+        ist ein Unterverzeichnis mit dem Header als JSON und dem Datenteil als
+        .npy-Datei in Fortran-Reihenfolge, d.h. spaltenweise abgelegt. Beim
+        Memory-Mapping werden so nur die Seiten der tatsächlich verwendeten
+        Spalten gelesen. Da der Schlüssel Größe und Änderungszeit enthält,
+        führen geänderte Dateien automatisch zu einem neuen Eintrag.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.size = sum([size for path,size,mtime in self.entries()])
+
+    def key(self,filename):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : str
+            SHA1 aus absolutem Pfad, Dateigröße und Änderungszeit (siehe
+            filetools.identity).
+        """
+        path,size,mtime = filetools.identity(filename)
+        return hashlib.sha1("|".join([path,str(size),repr(mtime)]).\
+            encode("utf-8")).hexdigest()
+
+    def entries(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of tuple
+            (Pfad, Größe in Byte, letzte Verwendung) für jeden Eintrag.
+        """
+        output = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory,name)
+            if not os.path.isdir(path) or name.startswith("tmp"):
+                continue
+            size = sum([os.path.getsize(os.path.join(path,f))
+                for f in os.listdir(path)])
+            output.append((path,size,os.path.getmtime(path)))
+        return output
+
+    def load(self,filename):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str
+            Pfad der DynaLog-Datei.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : tuple (dict, ndarray) or None
+            Header und Datenteil (copy-on-write memory-mapped), None falls kein
+            gültiger Eintrag vorhanden ist.
+        """
+        path = os.path.join(self.directory,self.key(filename))
+        try:
+            with open(os.path.join(path,"header.json"),"r") as data:
+                header = json.load(data)
+            raw_data = np.load(os.path.join(path,"raw_data.npy"),mmap_mode="c")
+        except (IOError,OSError,ValueError):
+            return None
+        os.utime(path,None)
+        #Änderungszeit des Eintrags dient als Zeitpunkt der letzten Verwendung.
+        return header,raw_data
+
+    def store(self,filename,header,raw_data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str
+            Pfad der DynaLog-Datei.
+
+        header : dict
+            header-Dictionary der Leafbank. "filename" und "side" werden nicht
+            gespeichert, da sie vom Aufrufer abhängen.
+
+        raw_data : ndarray
+            Datenteil der DynaLog-Datei.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Schreibt den Eintrag zunächst in ein temporäres Verzeichnis und benennt
+        es dann um, damit parallel lesende Prozesse nie halbfertige Einträge
+        sehen.
+        """
+        path = os.path.join(self.directory,self.key(filename))
+        if os.path.isdir(path):
+            return None
+        tmp = tempfile.mkdtemp(prefix="tmp",dir=self.directory)
+        with open(os.path.join(tmp,"header.json"),"w") as data:
+            json.dump(dict([(key,value) for key,value in header.items()
+                if key not in ["filename","side"]]),data)
+        np.save(os.path.join(tmp,"raw_data.npy"),np.asfortranarray(raw_data))
+        size = sum([os.path.getsize(os.path.join(tmp,f)) for f in os.listdir(tmp)])
+        try:
+            os.rename(tmp,path)
+        except OSError:
+            shutil.rmtree(tmp,ignore_errors=True)
+            return None
+        self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Beschreibung
+        -----------------------------------------------------------------------
+        Löscht die am längsten nicht verwendeten Einträge, bis die Gesamtgröße
+        wieder unter max_size liegt.
+        """
+        entries = sorted(self.entries(),key=lambda entry: entry[2])
+        self.size = sum([entry[1] for entry in entries])
+        for path,size,mtime in entries:
+            if self.size <= self.max_size:
+                break
+            shutil.rmtree(path,ignore_errors=True)
+            self.size -= size
+
+    def invalidate(self,filename=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str, default None
+            Löscht nur den Eintrag dieser Datei. Bei None wird der gesamte Cache
+            geleert.
+        """
+        if filename == None:
+            paths = [entry[0] for entry in self.entries()]
+        else:
+            paths = [os.path.join(self.directory,self.key(filename))]
+        for path in paths:
+            shutil.rmtree(path,ignore_errors=True)
+        self.size = sum([entry[1] for entry in self.entries()])
+
+class plan_cache:
+
+    def __init__(self,directory):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        directory : str
+            Verzeichnis, in dem die Cache-Einträge abgelegt werden. Wird bei
+            Bedarf angelegt.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        key :
+            Erzeugt den Schlüssel aus SOPInstanceUID und Änderungszeit.
+
+        load :
+            Liest einen vorhandenen Eintrag.
+
+        store :
+            Legt die ausgelesenen Daten eines Plans ab (plan.data).
+
+        invalidate :
+            Löscht einzelne oder alle Einträge.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Persistenter Cache für die Daten, die plan und beam aus einem RTPLAN
+        benötigen (siehe plan.extract_data): Header, sowie je Beam Typ,
+        Rotationsrichtung, Leafanzahl, Gantrywinkel, Meterset-Gewichte und
+        MLC-Positionen der Kontrollpunkte. Jeder Eintrag ist eine .npz-Datei,
+        Strings werden als String-Arrays und der Header als JSON abgelegt.
+        Gelesen wird ohne pickle. Die Einträge sind nur wenige kB groß, daher
+        wird anders als beim dynalog_cache nichts verdrängt.
+        """
+        self.directory = directory
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self,plan_uid,mtime):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : str
+            SHA1 aus Plan-UID und Änderungszeit der Datei.
+        """
+        return hashlib.sha1("|".join([plan_uid,repr(mtime)]).\
+            encode("utf-8")).hexdigest()
+
+    def load(self,plan_uid,mtime):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        plan_uid : str
+            SOPInstanceUID des Plans.
+
+        mtime : float
+            Änderungszeit der Datei, siehe filetools.identity.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict or None
+            Daten im Format von plan.extract_data, None falls kein gültiger
+            Eintrag vorhanden ist.
+        """
+        path = os.path.join(self.directory,self.key(plan_uid,mtime)+".npz")
+        try:
+            with np.load(path,allow_pickle=False) as arrays:
+                data = {"header":json.loads(str(arrays["header"])),"beams":[]}
+                for num in range(int(arrays["beam_count"])):
+                    beam_data = {"beam_type":str(arrays["beam_type_{0}".\
+                        format(num)])}
+                    if beam_data["beam_type"] == "DYNAMIC":
+                        beam_data.update({
+                            "direction":str(arrays["direction_{0}".format(num)]),
+                            "leaf_count":int(arrays["leaf_count_{0}".format(num)]),
+                            "gantry_angle":arrays["gantry_angle_{0}".format(num)],
+                            "meterset_weight":arrays["meterset_weight_{0}".\
+                                format(num)],
+                            "mlc":arrays["mlc_{0}".format(num)]})
+                    data["beams"].append(beam_data)
+                    #Statische Beams haben nur beam_type, siehe
+                    #beam.extract_dicomdata.
+        except (IOError,OSError,ValueError,KeyError):
+            return None
+        return data
+
+    def store(self,plan_uid,mtime,data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        plan_uid, mtime :
+            Siehe load.
+
+        data : dict
+            Daten im Format von plan.extract_data.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Schreibt zunächst in eine temporäre Datei und benennt sie dann um,
+        siehe dynalog_cache.store.
+        """
+        path = os.path.join(self.directory,self.key(plan_uid,mtime)+".npz")
+        if os.path.isfile(path):
+            return None
+        arrays = {"header":np.array(json.dumps(data["header"])),
+            "beam_count":np.array(len(data["beams"]))}
+        for num in range(len(data["beams"])):
+            for key,value in data["beams"][num].items():
+                arrays["{0}_{1}".format(key,num)] = np.asarray(value)
+        handle,tmp = tempfile.mkstemp(prefix="tmp",suffix=".npz",
+            dir=self.directory)
+        with os.fdopen(handle,"wb") as target:
+            np.savez(target,**arrays)
+        try:
+            os.rename(tmp,path)
+        except OSError:
+            os.remove(tmp)
+
+    def invalidate(self,plan_uid=None,mtime=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        plan_uid, mtime : default None
+            Löscht nur den Eintrag dieses Plans. Bei None wird der gesamte
+            Cache geleert.
+        """
+        if plan_uid == None:
+            names = [name for name in os.listdir(self.directory)
+                if name.endswith(".npz")]
+        else:
+            names = [self.key(plan_uid,mtime)+".npz"]
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory,name))
+            except OSError:
+                pass
+
+
+class directory_scan:
+
+    def __init__(self,top,ending,archives=False,index=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        top : str
+            Verzeichnis, das rekursiv durchsucht wird.
+
+        ending : str
+            Dateiendung, siehe filetools.find_files.
+
+        archives : boolean, default False
+            Siehe filetools.find_files.
+
+        index : index_tools.log_index, default None
+            Persistenter Index der Header. Dateien, die dort mit gleicher Größe
+            und Änderungszeit stehen, müssen auch nach einem Neustart nicht
+            erneut gelesen werden.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        refresh :
+            Durchsucht das Verzeichnis erneut und lädt nur neue oder geänderte
+            Dateien.
+
+        load :
+            Lädt eine Liste von Dateien (Pfad, Dateiname, Größe,
+            Änderungszeit). Ohne Unterklasse ist das Objekt jeder Datei ihr
+            Pfad, directory_scan verfolgt dann nur Änderungen im Verzeichnis.
+
+        update :
+            Übernimmt hinzugefügte und entfernte Objekte, z.B. in Listen oder
+            Gruppierungen der Unterklasse. Ohne Unterklasse passiert nichts.
+
+        Instanzvariablen
+        -----------------------------------------------------------------------
+        files : dict
+            Für jede bekannte Datei ein Tupel (Größe, Änderungszeit, Objekt).
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Basisklasse für inkrementelles Einlesen eines Verzeichnisses. Merkt
+        sich Größe und Änderungszeit aller bereits geladenen Dateien, sodass
+        ein erneuter Aufruf von refresh nur Aufwand für neue, geänderte oder
+        gelöschte Dateien verursacht.
+        """
+        self.top = top
+        self.ending = ending
+        self.archives = archives
+        self.index = index
+        self.files = {}
+
+    def refresh(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : tuple (list, list)
+            Neu geladene und entfernte Objekte (geänderte Dateien tauchen in
+            beiden Listen auf).
+        """
+        found = self.find()
+        removed = []
+        changed = []
+        for filename,f in found:
+            path,size,mtime = filetools.identity(filename)
+            known = self.files.get(filename)
+            if known == None or known[:2] != (size,mtime):
+                changed.append((filename,f,size,mtime))
+                if known != None:
+                    removed.append(known[2])
+        names = set([filename for filename,f in found])
+        for filename in list(self.files.keys()):
+            if filename not in names:
+                removed.append(self.files.pop(filename)[2])
+                if self.index != None:
+                    self.index.remove(filename)
+
+        objects = self.load(changed)
+        if self.index != None:
+            self.index.commit()
+        added = []
+        for (filename,f,size,mtime),item in zip(changed,objects):
+            self.files[filename] = (size,mtime,item)
+            if item != None:
+                added.append(item)
+        removed = [item for item in removed if item != None]
+        self.update(added,removed)
+        return added,removed
+
+    def find(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of tuple
+            (Pfad, Dateiname) aller aktuell vorhandenen Dateien.
+        """
+        if not os.path.isdir(str(self.top)):
+            return []
+        return filetools.find_files(self.top,self.ending,self.archives)
+
+    def load(self,files):
+        return [filename for filename,f,size,mtime in files]
+
+    def update(self,added,removed):
+        pass
+
+class plan_scan(directory_scan):
+
+    def __init__(self,top,workers=None,index=None,cache=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        top : str
+            DICOM-Verzeichnis.
+
+        workers : int, default None
+            Siehe filetools.get_plans.
+
+        cache : plan_cache, default None
+            Siehe filetools.get_plans. Wird auch für Pläne aus dem Index
+            verwendet, sodass deren Beams ohne DICOM-Zugriff konstruiert werden
+            können.
+
+        index : index_tools.log_index, default None
+            Dateien, die laut Index kein Plan mit Arcs sind (CT, Strukturen,
+            Dosis), werden übersprungen, ohne sie zu öffnen. Für bekannte Pläne
+            wird ein plan-Objekt direkt aus Header und Arcs des Index erzeugt.
+
+        Instanzvariablen
+        -----------------------------------------------------------------------
+        plans : list of plan objects
+            Entspricht dem Ergebnis von filetools.get_plans und wird von
+            refresh an Ort und Stelle aktualisiert.
+        """
+        directory_scan.__init__(self,top,"dcm",index=index)
+        self.workers = workers
+        self.cache = cache
+        self.plans = []
+
+    def load(self,files):
+        known = [None]*len(files)
+        data = [None]*len(files)
+        if self.index != None:
+            known = [self.index.lookup_plan(filename,size,mtime)
+                for filename,f,size,mtime in files]
+        if self.cache != None:
+            data = [self.cache.load(known[num]["plan_uid"],files[num][3])
+                if known[num] != None and known[num]["plan_uid"] != None
+                else None for num in range(len(files))]
+            known = [known[num] if data[num] != None or known[num] == None
+                or known[num]["plan_uid"] == None else None
+                for num in range(len(files))]
+            #Pläne ohne Cache-Eintrag werden einmal gelesen und abgelegt.
+
+        plans = filetools.load_plans([files[num][0] for num in range(len(files))
+            if known[num] == None],self.workers,self.cache)
+        output = []
+        for num in range(len(files)):
+            if known[num] != None:
+                if known[num]["plan_uid"] == None:
+                    output.append(None)
+                else:
+                    output.append(pl.plan(files[num][0],known[num],
+                        known[num]["arcs"],data=data[num]))
+                continue
+            plan = plans.pop(0)
+            output.append(plan)
+            if self.index != None:
+                self.index.store_plan(files[num][0],files[num][2],files[num][3],
+                    plan)
+                if plan != None:
+                    plan.release()
+        return output
+
+    def update(self,added,removed):
+        for plan in removed:
+            self.plans.remove(plan)
+        self.plans.extend(added)
+
+class bank_scan(directory_scan):
+
+    def __init__(self,top,mode="plan_uid",header_only=False,cache=None,
+        compact=False,workers=None,archives=True,index=None,summaries=False):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        top : str
+            DynaLog-Verzeichnis.
+
+        mode, header_only, cache, compact, workers, archives :
+            Siehe filetools.get_banks.
+
+        index : index_tools.log_index, default None
+            Mit header_only werden Header bekannter Dateien aus dem Index
+            übernommen, die Dateien selbst werden nicht geöffnet.
+
+        summaries : bool, default False
+            Berechnet beim Einlesen neuer oder geänderter Dateien einmalig
+            deren leaf_statistics und legt sie im Index ab. Nur mit index.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        summarize :
+            Berechnet die Leafstatistik einzelner Dateien, ggf. im Prozesspool.
+
+        summary :
+            Vereinigte Leafstatistik mehrerer Leafbänke.
+
+        Instanzvariablen
+        -----------------------------------------------------------------------
+        grouping : bank_groups
+            Alle Gruppierungen der bekannten Leafbänke.
+
+        groups : dict
+            Entspricht dem Ergebnis von filetools.get_banks für den aktuellen
+            Modus und wird von refresh an Ort und Stelle aktualisiert.
+        """
+        directory_scan.__init__(self,top,"dlg",archives,index)
+        self.mode = mode
+        self.header_only = header_only
+        self.cache = cache
+        self.compact = compact
+        self.workers = workers
+        self.summaries = summaries
+        self.grouping = bank_groups()
+        self.groups = self.grouping.groups[mode]
+
+    def load(self,files):
+        output = [None]*len(files)
+        if self.index != None and self.header_only == True:
+            for num in range(len(files)):
+                filename,f,size,mtime = files[num]
+                header = self.index.lookup_bank(filename,size,mtime)
+                if header != None:
+                    output[num] = leafbank_dynalog(filename,f[0],
+                        filetools.bank_columns,True,self.cache,self.compact,header)
+
+        missing = [num for num in range(len(files)) if output[num] == None]
+        banks = filetools.load_banks([files[num][:2] for num in missing],
+            self.header_only,self.cache,self.compact,self.workers)
+        for num,bank in zip(missing,banks):
+            output[num] = bank
+            if self.index != None:
+                self.index.store_bank(files[num][0],files[num][2],files[num][3],
+                    bank.header)
+
+        if self.index != None and self.summaries == True:
+            missing = [(filename,f[0],size,mtime) for filename,f,size,mtime
+                in files if self.index.lookup_summary(filename,size,mtime) == None]
+            for (filename,side,size,mtime),statistics in zip(missing,
+                self.summarize([(filename,side) for filename,side,size,mtime
+                in missing])):
+                self.index.store_summary(filename,size,mtime,statistics)
+        return output
+
+    def summarize(self,files):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        files : list of tuple
+            (Pfad, Seite) der Leafbänke.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of leaf_statistics
+            In der Reihenfolge von files.
+        """
+        jobs = [(filename,side,self.cache,self.compact) for filename,side
+            in files]
+        if self.workers == None or self.workers <= 1 or len(jobs) < 2:
+            return [_summarize_bank(job) for job in jobs]
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            return pool.map(_summarize_bank,jobs,chunksize=4)
+        finally:
+            pool.close()
+            pool.join()
+
+    def summary(self,banks):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        banks : list of leafbank_dynalog
+            Leafbänke aus diesem Scan, z.B. eine Gruppe aus groups.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : leaf_statistics
+            Vereinigte Statistik aller banks. Zusammenfassungen werden aus dem
+            Index gelesen, nur fehlende werden aus den Leafdaten berechnet
+            (und, falls ein Index vorhanden ist, dort abgelegt).
+        """
+        output = leaf_statistics()
+        missing = []
+        for bank in banks:
+            filename = bank.header["filename"]
+            statistics = None
+            if self.index != None and filename in self.files:
+                size,mtime = self.files[filename][:2]
+                statistics = self.index.lookup_summary(filename,size,mtime)
+            if statistics == None:
+                missing.append(bank)
+            else:
+                output.merge(statistics)
+
+        for bank,statistics in zip(missing,self.summarize([(bank.header[
+            "filename"],bank.header["side"]) for bank in missing])):
+            output.merge(statistics)
+            filename = bank.header["filename"]
+            if self.index != None and filename in self.files:
+                self.index.store_summary(filename,self.files[filename][0],
+                    self.files[filename][1],statistics)
+        if self.index != None and len(missing) > 0:
+            self.index.commit()
+        return output
+
+    def update(self,added,removed):
+        self.grouping.remove(removed)
+        self.grouping.add(added)
+
+    def set_mode(self,mode):
+        """
+        Wechselt die Gruppierung, ohne Dateien neu zu lesen oder Leafbänke
+        neu einzusortieren.
+        """
+        self.mode = mode
+        self.groups = self.grouping.groups[mode]
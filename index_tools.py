@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Klassen
+-------------------------------------------------------------------------------
+log_index :
+    Persistenter SQLite-Index der Header von DICOM-Plänen und DynaLog-Dateien
+    sowie der Leafstatistik je DynaLog-Datei.
+
+Beschreibung
+-------------------------------------------------------------------------------
+Hält die Metadaten bereits gelesener Dateien zusammen mit Pfad, Größe und
+Änderungszeit vor. Damit lassen sich Pläne und Leafbänke nach Plan-UID,
+Patient oder Beamnummer über indizierte Abfragen finden, ohne die Dateien
+erneut zu öffnen. Für die Statistik-Auswertung werden außerdem je Leafbank
+die Kennzahlen der Leafabweichung abgelegt, sodass beliebige Gruppierungen
+durch Vereinigen dieser Zusammenfassungen beantwortet werden können, ohne
+Leafdaten zu lesen.
+"""
+
+import io
+import json
+import sqlite3
+import numpy as np
+from import_tools import leaf_statistics
+
+class log_index:
+
+    plan_fields = ["plan_uid","patient_id","patient_name","plan_name","arcs",
+        "beam_numbers"]
+
+    bank_fields = ["side","version","plan_uid","patient_id","patient_name",
+        "beam_number","tolerance","leaf_count","coord_system"]
+
+    def __init__(self,filename):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename : str
+            Pfad der SQLite-Datenbank, wird bei Bedarf angelegt. ":memory:"
+            für einen nicht persistenten Index.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        lookup_plan, lookup_bank :
+            Liefert den gespeicherten Header einer Datei, falls Größe und
+            Änderungszeit noch übereinstimmen.
+
+        store_plan, store_bank :
+            Legt den Header einer Datei ab bzw. ersetzt ihn.
+
+        lookup_summary, store_summary :
+            Liest bzw. schreibt die Leafstatistik (leaf_statistics) einer
+            DynaLog-Datei.
+
+        remove :
+            Entfernt eine Datei aus dem Index.
+
+        commit :
+            Schreibt die Änderungen in die Datenbank.
+
+        plan_header, bank_header :
+            Wandeln eine Tabellenzeile in ein Header-Dictionary.
+
+        plans, banks :
+            Abfrage nach Plan-UID, Patienten-ID, Patientenname und
+            Beamnummer.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Zwei Tabellen, plans und banks, mit dem Dateipfad als Primärschlüssel
+        und Indizes auf allen Suchspalten. Die Nummern der dynamischen Beams
+        eines Plans stehen zusätzlich je Zeile in der Tabelle plan_beams, so
+        dass auch die Suche nach Beamnummer indiziert in SQL läuft. Die
+        Tabelle summaries enthält je
+        DynaLog-Datei die Arrays aus leaf_statistics.to_arrays als
+        komprimiertes npz. DICOM-Dateien, die keine Pläne mit
+        Arcs sind (CT-Schichten, Strukturen, ...), werden mit leerer Plan-UID
+        gespeichert, damit sie beim nächsten Durchsuchen übersprungen werden
+        können. Patientennamen werden wie in filetools.get_banks als
+        kommagetrennter String abgelegt.
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def create_tables(self):
+        """
+        Beschreibung
+        -----------------------------------------------------------------------
+        Legt Tabellen und Indizes an, falls sie noch nicht existieren. Fehlt
+        in einem bestehenden Index die Tabelle plan_beams, wird sie aus der
+        Spalte beam_numbers der Tabelle plans gefüllt.
+        """
+        migrate = self.connection.execute("SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'plan_beams'").fetchone() == None
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS plans ("
+                "filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                "plan_uid TEXT, patient_id TEXT, patient_name TEXT, "
+                "plan_name TEXT, arcs INTEGER, beam_numbers TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS banks ("
+                "filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                "side TEXT, version TEXT, plan_uid TEXT, patient_id TEXT, "
+                "patient_name TEXT, beam_number INTEGER, tolerance INTEGER, "
+                "leaf_count INTEGER, coord_system INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS plan_beams ("
+                "filename TEXT, beam_number INTEGER)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS summaries ("
+                "filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                "count INTEGER, data BLOB)")
+            for table,column in [("plans","plan_uid"),("plans","patient_id"),
+                ("plans","patient_name"),("banks","plan_uid"),
+                ("banks","patient_id"),("banks","patient_name"),
+                ("banks","beam_number"),("plan_beams","filename"),
+                ("plan_beams","beam_number")]:
+                self.connection.execute("CREATE INDEX IF NOT EXISTS "
+                    "{0}_{1} ON {0} ({1})".format(table,column))
+            if migrate == True:
+                for row in self.connection.execute("SELECT filename, "
+                    "beam_numbers FROM plans WHERE plan_uid IS NOT NULL")\
+                    .fetchall():
+                    self.store_beam_numbers(row["filename"],
+                        json.loads(row["beam_numbers"]))
+
+    def lookup(self,table,filename,size,mtime):
+        row = self.connection.execute("SELECT * FROM {0} WHERE filename = ?"\
+            .format(table),(filename,)).fetchone()
+        if row == None or row["size"] != size or row["mtime"] != mtime:
+            return None
+        return row
+
+    def lookup_plan(self,filename,size,mtime):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict or None
+            Header des Plans mit den Schlüsseln aus plan_fields. Bei Dateien,
+            die kein Plan mit Arcs sind, ist plan_uid None. None, falls die
+            Datei nicht oder in anderer Version im Index steht.
+        """
+        row = self.lookup("plans",filename,size,mtime)
+        if row == None:
+            return None
+        return self.plan_header(row)
+
+    def plan_header(self,row):
+        """
+        Wandelt eine Zeile der Tabelle plans in ein Header-Dictionary.
+        """
+        header = dict([(key,row[key]) for key in self.plan_fields])
+        if header["plan_uid"] != None:
+            header["patient_name"] = header["patient_name"].split(",")
+            header["beam_numbers"] = json.loads(header["beam_numbers"])
+        return header
+
+    def lookup_bank(self,filename,size,mtime):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict or None
+            header-Dictionary wie in leafbank_dynalog, ohne "filename". None,
+            falls die Datei nicht oder in anderer Version im Index steht.
+        """
+        row = self.lookup("banks",filename,size,mtime)
+        if row == None:
+            return None
+        return self.bank_header(row)
+
+    def bank_header(self,row):
+        """
+        Wandelt eine Zeile der Tabelle banks in ein Header-Dictionary.
+        """
+        header = dict([(key,row[key]) for key in self.bank_fields])
+        header["patient_name"] = header["patient_name"].split(",")
+        return header
+
+    def store_plan(self,filename,size,mtime,plan=None):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename, size, mtime :
+            Identität der Datei, siehe filetools.identity.
+
+        plan : plan object, default None
+            None für DICOM-Dateien, die kein Plan mit Arcs sind.
+        """
+        values = [filename,size,mtime] + [None]*len(self.plan_fields)
+        beam_numbers = []
+        if plan != None:
+            beam_numbers = [num+1 for num in range(len(plan.beams))
+                if plan.beams[num] == "dynamic"]
+            values[3:] = [plan.header["plan_uid"],plan.header["patient_id"],
+                ",".join(plan.header["patient_name"]),plan.header["plan_name"],
+                plan.arcs,json.dumps(beam_numbers)]
+        self.connection.execute("INSERT OR REPLACE INTO plans VALUES "
+            "(?,?,?,?,?,?,?,?,?)",values)
+        self.store_beam_numbers(filename,beam_numbers)
+
+    def store_beam_numbers(self,filename,beam_numbers):
+        """
+        Ersetzt die Zeilen eines Plans in der Tabelle plan_beams.
+        """
+        self.connection.execute("DELETE FROM plan_beams WHERE filename = ?",
+            (filename,))
+        self.connection.executemany("INSERT INTO plan_beams VALUES (?,?)",
+            [(filename,number) for number in beam_numbers])
+
+    def store_bank(self,filename,size,mtime,header):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename, size, mtime :
+            Identität der Datei, siehe filetools.identity.
+
+        header : dict
+            header-Dictionary einer leafbank_dynalog.
+        """
+        values = [filename,size,mtime] + [header[key] if key != "patient_name"
+            else ",".join(header[key]) for key in self.bank_fields]
+        self.connection.execute("INSERT OR REPLACE INTO banks VALUES "
+            "(?,?,?,?,?,?,?,?,?,?,?,?)",values)
+
+    def lookup_summary(self,filename,size,mtime):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : leaf_statistics or None
+            Leafstatistik der Datei. None, falls die Datei nicht oder in
+            anderer Version im Index steht.
+        """
+        row = self.lookup("summaries",filename,size,mtime)
+        if row == None:
+            return None
+        with np.load(io.BytesIO(row["data"]),allow_pickle=False) as arrays:
+            return leaf_statistics.from_arrays(arrays)
+
+    def store_summary(self,filename,size,mtime,statistics):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        filename, size, mtime :
+            Identität der Datei, siehe filetools.identity.
+
+        statistics : leaf_statistics
+            Leafstatistik der gesamten Datei.
+        """
+        data = io.BytesIO()
+        np.savez_compressed(data,**statistics.to_arrays())
+        self.connection.execute("INSERT OR REPLACE INTO summaries VALUES "
+            "(?,?,?,?,?)",(filename,size,mtime,statistics.count,
+            sqlite3.Binary(data.getvalue())))
+
+    def remove(self,filename):
+        """
+        Entfernt die Datei aus allen Tabellen.
+        """
+        self.connection.execute("DELETE FROM plans WHERE filename = ?",
+            (filename,))
+        self.connection.execute("DELETE FROM plan_beams WHERE filename = ?",
+            (filename,))
+        self.connection.execute("DELETE FROM banks WHERE filename = ?",
+            (filename,))
+        self.connection.execute("DELETE FROM summaries WHERE filename = ?",
+            (filename,))
+
+    def commit(self):
+        """
+        Schreibt alle Änderungen seit dem letzten Aufruf in die Datenbank.
+        store_plan, store_bank, store_summary und remove committen nicht
+        selbst, damit beim Durchsuchen großer Verzeichnisse nicht jede Datei
+        einzeln geschrieben wird.
+        """
+        self.connection.commit()
+
+    def query(self,table,fields,criteria):
+        for key in criteria.keys():
+            if key not in fields:
+                raise KeyError("unknown search field: {0}".format(key))
+        where = ["plan_uid IS NOT NULL"]
+        values = []
+        for key,value in sorted(criteria.items()):
+            if key == "patient_name" and isinstance(value,(list,tuple)):
+                value = ",".join(value)
+            if table == "plans" and key == "beam_number":
+                where.append("filename IN (SELECT filename FROM plan_beams "
+                    "WHERE beam_number = ?)")
+                value = int(value)
+            else:
+                where.append("{0} = ?".format(key))
+            values.append(value)
+        return self.connection.execute("SELECT * FROM {0} WHERE {1} "\
+            "ORDER BY filename".format(table," AND ".join(where)),values).fetchall()
+
+    def plans(self,**criteria):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        criteria :
+            Suchfelder plan_uid, patient_id, patient_name oder beam_number,
+            z.B. plans(patient_id="123"). Mit beam_number werden nur Pläne
+            geliefert, die einen dynamischen Beam mit dieser Nummer haben,
+            abgefragt über die Tabelle plan_beams.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of tuple
+            (Pfad, Header) aller passenden Pläne.
+        """
+        return [(row["filename"],self.plan_header(row)) for row in
+            self.query("plans",["plan_uid","patient_id","patient_name",
+            "beam_number"],criteria)]
+
+    def banks(self,**criteria):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        criteria :
+            Suchfelder plan_uid, patient_id, patient_name, beam_number oder
+            side, z.B. banks(plan_uid=uid,beam_number=2).
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of tuple
+            (Pfad, Header) aller passenden Leafbänke.
+        """
+        return [(row["filename"],self.bank_header(row)) for row in
+            self.query("banks",["plan_uid","patient_id","patient_name",
+            "beam_number","side"],criteria)]
+
+    def close(self):
+        self.connection.close()
@@ -14,6 +14,9 @@ BeamMismatchError :
 PlanMismatchError :
     Wird bei Metadatenfehlern auf Planobjekt-Ebene ausgelöst.
 
+MismatchCollectionError :
+    Fasst alle bei einer Validierung gefundenen Fehler zusammen.
+
 leafbank :
     Stellt die Informationen einer DynaLog-Datei in leicht zugänglicher Weise bereit.
 
@@ -25,6 +28,10 @@ plan :
     Fasst beliebig viele Beams zu einem Plan unter einer Plan-UID zusammen. Es
     müssen wiederum alle Header-Daten übereinstimmen.
 
+dataset_pool :
+    Hält geladene DICOM-Datensätze von Plänen innerhalb eines Speicherbudgets
+    vor.
+
 Beschreibung
 -------------------------------------------------------------------------------
 Enthält Fehler und Objektklassen, um den Umgang mit DynaLog-Dateien bequem und
@@ -33,8 +40,11 @@ einfach zu machen.
 
 import numpy as np
 import dicom as dcm
+import collections
+import threading
 import copy
 import time
+import os
 
 class DynalogMismatchError(Exception):
     """
@@ -145,9 +155,43 @@ class PlanMismatchError(DynalogMismatchError):
         return "\nPlan {0}\n{1} mismatch: {2}"\
         .format(self.plan_uid,self.key,self.msg)
 
+class MismatchCollectionError(DynalogMismatchError):
+
+    def __init__(self,errors):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        errors : list of DynalogMismatchError
+            Alle in einem Validierungsdurchlauf gefundenen Fehler.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Wird ausgelöst, wenn eine Validierung mehr als einen Fehler findet,
+        damit nicht nur die erste Abweichung gemeldet wird. Enthaltene
+        MismatchCollectionErrors werden aufgelöst.
+        """
+        self.errors = []
+        for error in errors:
+            self.errors.extend(getattr(error,"errors",[error]))
+
+    def __str__(self):
+        return "".join([str(error) for error in self.errors])+\
+            "\n{0} mismatches found".format(len(self.errors))
+
+    @classmethod
+    def raise_errors(self,errors):
+        """
+        Wirft bei genau einem Fehler diesen selbst, bei mehreren einen
+        MismatchCollectionError. Ohne Fehler passiert nichts.
+        """
+        if len(errors) == 1:
+            raise errors[0]
+        elif len(errors) > 1:
+            raise self(errors)
+
 class beam:
 
-    def __init__(self,banks,dicom_header=None,dicom_beam=None):
+    def __init__(self,banks,dicom_header=None,dicom_beam=None,beam_data=None):
         """
         Parameter
         -----------------------------------------------------------------------
@@ -160,7 +204,13 @@ class beam:
             Element der BeamSequence-Liste aus DICOM-Objekt. Übergibt alle
             anderen "Soll"-Werte für intuitive Aufbewahrung im jeweiligen Beam.
             Falls kein Wert übergeben wird, überspringt die Init-Funktion den
-            DICOM-Teil.
+            DICOM-Teil. Wird für den Export benötigt und kann bis dahin
+            nachgereicht werden, wenn beam_data übergeben wurde.
+
+        beam_data : dict, default None
+            Bereits aus dem DICOM-Beam ausgelesene Sollwerte, siehe
+            extract_dicomdata. Falls übergeben, wird dicom_beam für
+            construct_dicomdata nicht benötigt.
 
         banks : list
             Liste von 2 Leafbank-Objekten, die dann im Beam-Objekt gespeichert
@@ -170,14 +220,17 @@ class beam:
         -----------------------------------------------------------------------
         construct_dicomdata :
             Falls dicom_header übergeben wurde, wird dieser in Objekteigenschaft
-            übernommen und anschließend dicom_beam ausgewertet. Falls nicht,
-            wird die Funktion beendet.
+            übernommen und anschließend beam_data bzw. dicom_beam ausgewertet.
+            Falls nicht, wird die Funktion beendet.
+
+        extract_dicomdata :
+            Liest die Sollwerte eines DICOM-Beams in numpy-Arrays aus.
 
         construct_logdata :
-            Prüft zunächst mittels check_leafbank_data, ob die Leafbankdaten
-            stimmig sind. Falls ja, werden Dosis, Gantrywinkel, identische
-            Headerdaten und das previous segment Array in Eigenschaften des
-            Beams übertragen, um sie leichter zugänglich zu machen.
+            Übernimmt die Headerdaten der Leafbänke und prüft dann mittels
+            validate_beam, ob Leafbänke und Beam stimmig sind. Falls ja, werden
+            Dosis und Gantrywinkel in Eigenschaften des Beams übertragen, um
+            sie leichter zugänglich zu machen.
 
         convert_angles :
             Rechnet Winkel vom Plan- ins Dynalog-Format um (und umgekehrt).
@@ -203,6 +256,10 @@ class beam:
         check_leafbank_data :
             Prüft, ob die Metadaten der Leafbänke sinnvoll übereinstimmen.
 
+        collect_leafbank_errors, collect_beam_errors :
+            Sammeln alle Abweichungen für check_leafbank_data bzw.
+            check_beam_metadata.
+
         check_beam_metadata :
             Prüft, ob die Metadaten der Dynalog- und DICOM-Header des Beams
             zusammen passen.
@@ -217,6 +274,10 @@ class beam:
             Gibt an, ob die Metadaten des Beams und der Leafbänke bereits auf
             Konsistenz geprüft wurden.
 
+        checked : tuple
+            Header und geprüfte Arrays der Leafbänke bei der letzten
+            erfolgreichen Prüfung durch check_leafbank_data.
+
         dicom_header : dict
             Enthält die Soll-Metadaten, die aus dem DICOM Planobjekt ausgelesen
             werden.
@@ -234,9 +295,12 @@ class beam:
 
         dicom_mlc : ndarray
             Die MLC-Positionen aus DICOM-File. Format:
-             (Anzahl Kontrollpunkte,Anzahl Leafpaare), wobei Seite B zuerst
+             (Anzahl Kontrollpunkte,2*Anzahl Leafpaare), wobei Seite B zuerst
              kommt.
 
+        beam_data : dict
+            Sollwerte des Beams als Arrays, siehe extract_dicomdata.
+
         log_dose : ndarray
             DynaLog-Daten zur Dosis.
 
@@ -248,7 +312,8 @@ class beam:
             sind.
 
         log_previous_segment : ndarray
-            Die Segmentangaben aus den DynaLog-Files.
+            Die Segmentangaben aus den DynaLog-Files. Derzeit nicht gesetzt,
+            pick_controlpoints liest sie bei Bedarf direkt aus der Leafbank.
 
         banks : list
             Liste von 2 leafbank-Objekten.
@@ -260,25 +325,26 @@ class beam:
         prüfen.
         """
         self.validated = False
+        self.checked = None
 
         self.dicom_header = dicom_header
         self.dicom_beam = dicom_beam
+        self.beam_data = beam_data
         self.construct_dicomdata()
 
         if banks != None:
-            self.banks = list(np.array(banks)[np.argsort([banks[0].\
-                header["side"],banks[0].header["side"]])])
+            self.banks = sorted(banks,key=lambda bank: bank.header["side"])
             #Stellt sicher dass stets Seite A an erster Stelle der Leafbänke steht.
             self.construct_logdata()
-            self.validate_beam()
 
     def construct_dicomdata(self):
         """
         Beschreibung
         -----------------------------------------------------------------------
-        Nimmt das DICOM-Objekt in self.dicom_beam auseinander. Dosis der
-        einzelnen Kontrollpunkte wird in Array gepackt, mit 25000 multipliziert
-        um mit DynaLog konform zu gehen.
+        Nimmt die Sollwerte in self.beam_data auseinander, die bei Bedarf
+        zuvor aus self.dicom_beam ausgelesen werden. Dosis der einzelnen
+        Kontrollpunkte wird mit 25000 multipliziert um mit DynaLog konform zu
+        gehen.
 
         Gantrywinkel wird direkt übernommen. Wichtig: Unterschiede im Koordinaten-
         system bzgl. Winkel beachten.
@@ -288,22 +354,61 @@ class beam:
         """
         if self.dicom_header == None:
             return None
-        self.dicom_dose = 25000*np.array([self.dicom_beam.ControlPointSequence[num].
-        CumulativeMetersetWeight for num in range(self.dicom_beam.NumberOfControlPoints)])
+        if self.beam_data == None:
+            self.beam_data = self.extract_dicomdata(self.dicom_beam)
+        self.dicom_dose = 25000*self.beam_data["meterset_weight"]
+        self.dicom_gantry_angle = self.beam_data["gantry_angle"]
+        self.dicom_mlc = self.beam_data["mlc"]
+        self.direction = self.beam_data["direction"]
 
-        self.dicom_gantry_angle = np.array([self.dicom_beam.ControlPointSequence[num].
-        GantryAngle for num in range(self.dicom_beam.NumberOfControlPoints)])
-
-#        self.dicom_mlc = [[self.dicom_beam.ControlPointSequence[num].
-#            BeamLimitingDevicePositionSequence[0].
-#            LeafJawPositions] for num in range(1,self.dicom_beam.NumberOfControlPoints)]
-#        self.dicom_mlc = np.insert(self.dicom_mlc,0,self.dicom_beam.
-#            ControlPointSequence[0].BeamLimitingDevicePositionSequence[2].
-#            LeafJawPositions)
+    @classmethod
+    def extract_dicomdata(self,dicom_beam):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        dicom_beam : dicom.dataset.Dataset
+            Element der BeamSequence-Liste aus DICOM-Objekt.
 
-        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
+        Beschreibung
+        -----------------------------------------------------------------------
+        Einziger Zugriff auf die Kontrollpunkte eines DICOM-Beams. Das Ergebnis
+        besteht nur aus Strings, Zahlen und Arrays und kann daher ohne pickle
+        zwischengespeichert werden (siehe import_tools.plan_cache). Kontroll-
+        punkte ohne eigene MLC-Positionen übernehmen die des vorherigen.
+        Kontrollpunkte werden nur für dynamische Beams gelesen, statische
+        Felder (Setup-, Jaw- oder Elektronenfelder) haben oft gar kein MLC.
 
-        self.direction = self.dicom_beam.ControlPointSequence[0].GantryRotationDirection
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict
+            beam_type, bei dynamischen Beams außerdem direction, leaf_count,
+            gantry_angle und meterset_weight (je Kontrollpunkt) sowie mlc
+            (Kontrollpunkte x 2*leaf_count, Seite B zuerst).
+        """
+        if dicom_beam.BeamType != "DYNAMIC":
+            return {"beam_type":str(dicom_beam.BeamType)}
+        points = dicom_beam.ControlPointSequence
+        leaf_count = int([device for device in
+            dicom_beam.BeamLimitingDeviceSequence if device.
+            RTBeamLimitingDeviceType[:3] == "MLC"][0].NumberOfLeafJawPairs)
+        mlc = np.zeros((len(points),2*leaf_count))
+        for num in range(len(points)):
+            positions = [device.LeafJawPositions for device in
+                getattr(points[num],"BeamLimitingDevicePositionSequence",[])
+                if device.RTBeamLimitingDeviceType[:3] == "MLC"]
+            if len(positions) > 0:
+                mlc[num] = [float(value) for value in positions[0]]
+            elif num > 0:
+                mlc[num] = mlc[num-1]
+
+        return {"beam_type":str(dicom_beam.BeamType),
+            "direction":str(points[0].GantryRotationDirection),
+            "leaf_count":leaf_count,
+            "gantry_angle":np.array([float(point.GantryAngle)
+                for point in points]),
+            "meterset_weight":np.array([float(point.CumulativeMetersetWeight)
+                for point in points]),
+            "mlc":mlc}
 
 
     def construct_logdata(self):
@@ -312,18 +417,20 @@ class beam:
         -----------------------------------------------------------------------
         Schreibt Dosis, Gantrywinkel, Header und Segmentnummern aus den
         Leafbänken in Beamvariablen, da sie so logischer/bequemer anzusprechen
-        sind.
+        sind. Vorher werden Leafbänke und Metadaten mit validate_beam geprüft,
+        bevor auf die Arrays zugegriffen wird; alle Abweichungen werden
+        gemeinsam gemeldet.
         """
-        if self.check_leafbank_data() == True:
-            self.log_dose = 1*self.banks[0].dose_fraction
-            self.log_gantry_angle = self.banks[0].gantry_angle/10.
-            self.log_header = copy.deepcopy(self.banks[0].header)
-#            self.log_previous_segment = 1*self.banks[0].previous_segment
-            #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
-
-            del self.log_header["version"]
-            del self.log_header["side"]
-            del self.log_header["filename"]
+        self.log_header = copy.deepcopy(self.banks[0].header)
+        del self.log_header["version"]
+        del self.log_header["side"]
+        del self.log_header["filename"]
+
+        self.validate_beam()
+        self.log_dose = 1*self.banks[0].dose_fraction
+        self.log_gantry_angle = self.banks[0].gantry_angle/10.
+#        self.log_previous_segment = 1*self.banks[0].previous_segment
+        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
 
     @classmethod
     def convert_angles(self,data):
@@ -350,18 +457,31 @@ class beam:
         """
         return (540 - np.array(data))%360
 
-    def convert_mlc(self,export_expected=False,leafgap=0.7):
+    def convert_mlc(self,export_expected=False,leafgap=0.7,index=None):
         """
+        Parameter
+        -----------------------------------------------------------------------
+        index : array-like, default None
+            Zeilen des DynaLogs, die umgerechnet werden sollen, z.B. das
+            Ergebnis von pick_controlpoints. Bei None werden alle Zeilen
+            umgerechnet.
+
         Beschreibung
         -----------------------------------------------------------------------
         Fügt die Leafpositionen von Bank A und B passend aneinander, um sie
         in DICOM-Format zu bringen.
 
+        Es werden zuerst die benötigten Zeilen ausgewählt und dann Rundung,
+        Überlappungskorrektur und Leaf-Gap-Aufweitung direkt im Ausgabearray
+        ausgeführt. Außer der Ausgabe wird nur ein Hilfsarray gleicher Größe
+        (und zwei Masken) angelegt, der Speicherbedarf richtet sich also nach
+        der Anzahl der Kontrollpunkte, nicht nach der Länge des Logs.
+
         Ausgabe
         -----------------------------------------------------------------------
         output : ndarray
             Dimension (x,120), wobei x die Anzahl an aufgezeichneten Datenpunkten
-            des DynaLogs ist.
+            des DynaLogs bzw. die Länge von index ist.
         -----------------------------------------------------------------------
         """
         if self.validated == False: raise BeamMismatchError(
@@ -371,32 +491,58 @@ class beam:
         elif self.validated == True:
 
             if export_expected == False:
-                s2 = np.round(self.banks[0].leafs_actual/51.,2)
-                s1 = np.round(-1*self.banks[1].leafs_actual/51.,2)
+                bank_a = self.banks[0].leafs_actual
+                bank_b = self.banks[1].leafs_actual
 
             elif export_expected == True:
-                s2 = np.round(self.banks[0].leafs_expected/51.,2)
-                s1 = np.round(-1*self.banks[1].leafs_expected/51.,2)
-
-            x1 = np.where(s2-s1 < 0,s1+(s2-s1)/2.-0.01,s1)
-            x2 = np.where(s2-s1 < 0,s2-(s2-s1)/2.+0.01,s2)
+                bank_a = self.banks[0].leafs_expected
+                bank_b = self.banks[1].leafs_expected
+
+            if index is not None:
+                bank_a = bank_a[index]
+                bank_b = bank_b[index]
+            leafs = bank_a.shape[1]
+
+            output = np.empty((bank_a.shape[0],2*leafs))
+            x1 = output[:,:leafs]
+            x2 = output[:,leafs:]
+            np.divide(bank_b,-51.,out=x1)
+            np.round(x1,2,out=x1)
+            np.divide(bank_a,51.,out=x2)
+            np.round(x2,2,out=x2)
+            #Division durch float, damit auch kompakte Integer-Leafbänke
+            #(leafbank_dynalog mit compact=True) hier erst umgerechnet werden.
+
+            gap = np.subtract(x2,x1)
+            mask = np.less(gap,0)
+            np.divide(gap,2.,out=gap)
+            np.add(x1,gap,out=x1,where=mask)
+            np.subtract(x1,0.01,out=x1,where=mask)
+            np.subtract(x2,gap,out=x2,where=mask)
+            np.add(x2,0.01,out=x2,where=mask)
             #sorgt dafür, dass keine negativen Feldgrößen auftauchen.
 
-            x11 = np.where((x2-x1 < 0.6)*(x2-x1 > 0.02),x1-(leafgap-(x2-x1))/2.,x1)
-            x22 = np.where((x2-x1 < 0.6)*(x2-x1 > 0.02),x2+(leafgap-(x2-x1))/2.,x2)
+            np.subtract(x2,x1,out=gap)
+            np.less(gap,0.6,out=mask)
+            mask &= np.greater(gap,0.02)
+            np.subtract(leafgap,gap,out=gap)
+            np.divide(gap,2.,out=gap)
+            np.subtract(x1,gap,out=x1,where=mask)
+            np.add(x2,gap,out=x2,where=mask)
             #Stellt sicher, dass der Dynamic Leaf Gap stets ausreichend groß
             #für Verarbeitung in Eclipse ist. Dynamic Leafs werden angenommen,
             #wenn der Abstand größer als 0,6 mm ist. Sicher nicht die schönste
             #Art, diese beiden Probleme zu lösen...
 
-            return np.append(x11,x22,axis=1)
+            return output
+
     def pick_controlpoints(self,criterion="angle"):
         """
         Parameter
         -----------------------------------------------------------------------
         criterion : str
-            Möglich sind "dose" oder "angle". Wählt aus, nach welchem
-            Kriterium die Kontrollpunkte zusammengestellt werden.
+            Möglich sind "dose", "angle" oder "segment". Wählt aus, nach
+            welchem Kriterium die Kontrollpunkte zusammengestellt werden.
 
 
         Beschreibung
@@ -410,39 +556,186 @@ class beam:
         Die Stadardwerte (segment und last) lieferten in kurzen Tests die
         besten Ergebnisse.
 
+        Für jeden Kontrollpunkt außer dem letzten wird der erste Logeintrag
+        gesucht, der ihn erreicht (Dosis >= Soll, Winkel <= Soll bei CW bzw.
+        >= Soll bei CC). Der letzte Kontrollpunkt ist immer der letzte
+        Logeintrag. Bei "segment" ist der Kontrollpunkt k erreicht, sobald die
+        Segmentnummer (previous_segment, Spalte 1 der Leafbank) k erreicht.
+        Die Spalte wird erst dann nachgeladen. Statt jeden Kontrollpunkt
+        einzeln gegen das gesamte Log zu
+        vergleichen, wird das laufende Maximum (bzw. Minimum) der Logwerte
+        gebildet und alle Kontrollpunkte in einem Schritt per searchsorted
+        zugeordnet, mit identischem Ergebnis. Gantrywinkel werden vorher mit
+        unwrap_angles stetig gemacht, damit Bögen über den 0°/360°-Sprung des
+        DynaLog-Koordinatensystems hinweg korrekt zugeordnet werden.
+
         Ausgabe
         -----------------------------------------------------------------------
         output : ndarray
             Array mit Indizes, das ohne weitere Verarbeitung für log_dose,
             log_gantry_angle und Leafbank-Positionen verwendet werden kann.
+            Wird ein Kontrollpunkt von keinem Logeintrag erreicht, wird ein
+            BeamMismatchError mit allen betroffenen Kontrollpunkten geworfen.
         """
-        index = []
+        log,planned = self.controlpoint_axis(criterion)
+        return np.append(self.search_controlpoints(log,planned,criterion),-1)
 
-        if criterion == "dose":
-            for dose in self.dicom_dose[:-1]:
-                index.append(np.nonzero(self.log_dose >= dose)[0][0])
-            index.append(-1)
-            return index
+    def controlpoint_axis(self,criterion="angle"):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        criterion : str
+            Siehe pick_controlpoints.
 
-        elif criterion == "angle":
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : tuple (ndarray, ndarray)
+            Aufsteigend sortierte Logwerte (laufendes Maximum, bei CW mit
+            umgedrehtem Vorzeichen) und die Sollwerte aller Kontrollpunkte
+            außer dem letzten auf derselben Achse.
+        """
+        if criterion == "dose":
+            log = np.maximum.accumulate(self.log_dose)
+            planned = self.dicom_dose[:-1]
+
+        elif criterion == "segment":
+            log = np.maximum.accumulate(self.banks[0].previous_segment)
+            planned = np.arange(len(self.dicom_dose)-1)
+            #Das laufende Maximum springt genau an den Segmentwechseln, die
+            #Suche liefert also den ersten Eintrag jedes Segments.
+
+        elif criterion == "angle" and self.direction in ["CW","CC"]:
+            log = self.unwrap_angles(self.log_gantry_angle)
+            planned = self.unwrap_angles(self.convert_angles(
+                self.dicom_gantry_angle))
+            planned = planned[:-1] + 360*np.round((log[0]-planned[0])/360.)
+            #Plan auf dieselbe Umdrehung wie das Log schieben.
             if self.direction == "CW":
-                for angle in self.convert_angles(self.dicom_gantry_angle)[:-1]:
-                    index.append(np.nonzero(self.log_gantry_angle <= angle)[0][0])
-                index.append(-1)
-                return index
+                log = -np.minimum.accumulate(log)
+                planned = -planned
+                #Fallende Winkel: Vorzeichen drehen, damit searchsorted
+                #wieder auf einem aufsteigenden Array arbeitet.
+            else:
+                log = np.maximum.accumulate(log)
+
+        else:
+            raise ValueError("unknown criterion {0} for gantry rotation "
+                "{1}".format(criterion,self.direction))
+        return log,planned
+
+    def search_controlpoints(self,log,planned,criterion="angle"):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Index des ersten Logeintrags, der den jeweiligen Sollwert erreicht,
+            siehe controlpoint_axis. BeamMismatchError, falls Sollwerte nicht
+            erreicht werden.
+        """
+        index = np.searchsorted(log,planned,side="left")
+        missing = np.nonzero(index >= len(log))[0]
+        if len(missing) > 0:
+            raise BeamMismatchError(self.dicom_header["plan_uid"],
+                self.dicom_header["beam_number"],"control point",
+                "not reached by DynaLog ({0}): control points {1}".format(
+                criterion,", ".join([str(num) for num in missing])))
+        return index
+
+    def controlpoint_positions(self,criterion="angle"):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        criterion : str
+            "dose", "angle" oder "segment", siehe pick_controlpoints.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Wie pick_controlpoints, liefert aber die exakte Lage jedes
+        Kontrollpunkts zwischen zwei Logeinträgen. Zwischen dem letzten
+        Eintrag unterhalb des Sollwerts und dem ersten, der ihn erreicht,
+        wird linear interpoliert. Ist schon der erste Eintrag am Sollwert,
+        ist die Position 0.
+
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Gebrochene Indizes (float), letzter Kontrollpunkt ist der letzte
+            Logeintrag. Verwendung mit resample.
+        """
+        log,planned = self.controlpoint_axis(criterion)
+        upper = self.search_controlpoints(log,planned,criterion)
+        lower = np.maximum(upper-1,0)
+        step = log[upper]-log[lower]
+        weight = np.where(step > 0,(planned-log[lower])/np.where(step > 0,
+            step,1),0)
+        return np.append(lower+weight,len(log)-1)
+
+    @classmethod
+    def resample(self,data,positions):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        data : ndarray
+            Logdaten, eine Zeile pro Logeintrag (1D oder 2D, z.B. das Ergebnis
+            von convert_mlc).
+
+        positions : ndarray
+            Gebrochene Indizes, siehe controlpoint_positions.
 
-            if self.direction=="CC":
-                for angle in self.convert_angles(self.dicom_gantry_angle)[:-1]:
-                    index.append(np.nonzero(self.log_gantry_angle >= angle)[0][0])
-                index.append(-1)
-                return index
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Zwischen benachbarten Zeilen linear interpolierte Daten, eine Zeile
+            pro Position, für alle Spalten (Leafs) gleichzeitig.
+        """
+        positions = np.asarray(positions,dtype=float)
+        lower = np.floor(positions).astype(int)
+        upper = np.minimum(lower+1,len(data)-1)
+        weight = (positions-lower).reshape((-1,)+(1,)*(np.ndim(data)-1))
+        return (1-weight)*data[lower] + weight*data[upper]
+
+    @classmethod
+    def unwrap_angles(self,data):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        data : array-like
+            Winkel in Grad zwischen 0 und 360.
 
-    def export_logbeam(self,export_expected=False,leafgap=0.7):
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : ndarray
+            Winkel, bei denen Sprünge von mehr als 180° zwischen zwei Werten
+            durch Addition von Vielfachen von 360° beseitigt sind. Ohne
+            Sprünge bleiben die Werte exakt unverändert.
         """
+        data = np.asarray(data,dtype=float)
+        if len(data) < 2:
+            return data
+        turns = np.cumsum(np.round(-np.diff(data)/360.))
+        return data + 360*np.append(0,turns)
+
+    def export_logbeam(self,export_expected=False,leafgap=0.7,interpolate=False,
+        criterion="angle"):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        interpolate : boolean, default False
+            Interpoliert MLC-Positionen und Dosis auf die exakten Sollwerte
+            der Kontrollpunkte (siehe controlpoint_positions), statt den
+            ersten Logeintrag zu verwenden, der den Sollwert erreicht.
+
+        criterion : str, default "angle"
+            Kriterium der Kontrollpunktzuordnung, siehe pick_controlpoints.
+
         Beschreibung
         -----------------------------------------------------------------------
         Ersetzt MLC, Gantrywinkel und Dosis einer Kopie des DICOM Beamobjekts
-        mit den Werten aus DynaLogs.
+        mit den Werten aus DynaLogs. Neu erzeugt werden nur die Kontrollpunkte
+        und darin die geänderten Elemente (LeafJawPositions,
+        CumulativeMetersetWeight, CumulativeDoseReferenceCoefficient) samt der
+        Sequenzen, die sie enthalten, alles andere wird mit dicom_beam geteilt
+        (siehe replace_elements).
 
         Ausgabe
         -----------------------------------------------------------------------
@@ -450,25 +743,96 @@ class beam:
             DICOM Beam-Objekt das direkt in Plan-Objekte als Teil von BeamSequence
             integriert werden kann.
         """
-        index = self.pick_controlpoints()
-        exportbeam = copy.deepcopy(self.dicom_beam)
-
-        mlc = self.convert_mlc(export_expected,leafgap)[index]
-        dose = 1./25000*self.log_dose[index]
+        if interpolate == True:
+            positions = self.controlpoint_positions(criterion)
+            lower = np.floor(positions).astype(int)
+            rows = np.column_stack([lower,np.minimum(lower+1,
+                len(self.log_dose)-1)]).ravel()
+            mlc = np.round(self.resample(self.convert_mlc(export_expected,
+                leafgap,rows),2*np.arange(len(positions))+positions-lower),2)
+            #Nur die beiden Nachbarzeilen jedes Kontrollpunkts umrechnen,
+            #abwechselnd angeordnet, und dazwischen interpolieren.
+            dose = 1./25000*self.resample(self.log_dose,positions)
+        else:
+            index = self.pick_controlpoints(criterion)
+            mlc = self.convert_mlc(export_expected,leafgap,index)
+            dose = 1./25000*self.log_dose[index]
+
+        points = []
+        for num in range(len(self.dicom_beam.ControlPointSequence)):
+            point = self.dicom_beam.ControlPointSequence[num]
+            device = 2 if num == 0 else 0
+            devices = list(point.BeamLimitingDevicePositionSequence)
+            devices[device] = self.replace_elements(devices[device],
+                LeafJawPositions=list(mlc[num,:]))
+            if num == 0:
+                points.append(self.replace_elements(point,
+                    BeamLimitingDevicePositionSequence=devices))
+                continue
+
+            references = list(point.ReferencedDoseReferenceSequence)
+            references[0] = self.replace_elements(references[0],
+                CumulativeDoseReferenceCoefficient=dose[num])
+            points.append(self.replace_elements(point,
+                BeamLimitingDevicePositionSequence=devices,
+                CumulativeMetersetWeight=dose[num],
+                ReferencedDoseReferenceSequence=references))
+
+        return self.replace_elements(self.dicom_beam,ControlPointSequence=points)
 
-        exportbeam.ControlPointSequence[0].\
-            BeamLimitingDevicePositionSequence[2].LeafJawPositions = list(mlc[0,:])
+    @classmethod
+    def replace_elements(self,dataset,**values):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        dataset : dicom.dataset.Dataset
+            Ausgangsdatensatz, wird nicht verändert.
 
-        for num in range(1,len(self.dicom_beam.ControlPointSequence)):
-            exportbeam.ControlPointSequence[num].\
-                BeamLimitingDevicePositionSequence[0].LeafJawPositions = list(mlc[num,:])
+        values :
+            Neue Werte, z.B. LeafJawPositions=[...]. Bei vorhandenen
+            Elementen wird deren VR übernommen, fehlende Elemente (z.B.
+            StudyID oder ApprovalStatus bei manchen Exporten) werden mit dem
+            VR aus dem DICOM-Wörterbuch angelegt. Listen für Sequenzen werden
+            in dicom.sequence.Sequence umgewandelt.
 
-            exportbeam.ControlPointSequence[num].\
-                CumulativeMetersetWeight = dose[num]
-            exportbeam.ControlPointSequence[num].ReferencedDoseReferenceSequence[0].\
-                CumulativeDoseReferenceCoefficient = dose[num]
+        Beschreibung
+        -----------------------------------------------------------------------
+        Copy-on-write für DICOM-Datensätze: Statt einer tiefen Kopie wird
+        ein neuer Datensatz mit eigenem Element-Dictionary erzeugt, der alle
+        unveränderten DataElements mit dem Ausgangsdatensatz teilt. Die zu
+        ändernden Elemente werden durch neue DataElements ersetzt. Eine
+        Zuweisung per Attribut würde dagegen das geteilte Element und damit
+        auch den Ausgangsdatensatz ändern.
 
-        return exportbeam
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dicom.dataset.Dataset
+            Neuer Datensatz mit ersetzten Elementen, bei FileDataset samt
+            eigener Kopie von file_meta.
+        """
+        elements = dict([(element.tag,element) for element in dataset])
+        if isinstance(dataset,dcm.dataset.FileDataset):
+            output = dcm.dataset.FileDataset(dataset.filename,elements,
+                preamble=dataset.preamble,
+                file_meta=self.replace_elements(dataset.file_meta),
+                is_implicit_VR=dataset.is_implicit_VR,
+                is_little_endian=dataset.is_little_endian)
+            #write_file ergänzt ggf. fehlende Meta-Elemente, das darf nicht
+            #im Ausgangsdatensatz landen.
+        else:
+            output = dcm.dataset.Dataset(elements)
+        for keyword,value in values.items():
+            tag = dcm.datadict.tag_for_name(keyword)
+            if tag == None:
+                raise KeyError("unknown DICOM keyword {0}".format(keyword))
+            if tag in dataset:
+                VR = dataset[tag].VR
+            else:
+                VR = dcm.datadict.dictionaryVR(tag)
+            if VR == "SQ":
+                value = dcm.sequence.Sequence(value)
+            output[tag] = dcm.dataelem.DataElement(tag,VR,value)
+        return output
 
 
     def check_leafbank_data(self):
@@ -478,44 +842,69 @@ class beam:
         Prüft, ob Metadaten der Leafbänke sinnvoll zusammen passen, und ob
         Daten des Beams und der Bänke übereinstimmen.
 
+        Header und Arrays werden je Leafbankpaar genau einmal verglichen, siehe
+        collect_leafbank_errors. Nach einer erfolgreichen Prüfung werden die
+        geprüften Spalten schreibgeschützt und in checked festgehalten. Sind
+        die Header gleich und die Spalten noch dieselben Arrayobjekte, ist
+        damit auch ihr Inhalt unverändert, und es wird ohne erneuten Vergleich
+        True zurückgegeben. Neu zugewiesene Spalten werden wieder verglichen.
+
         Ausgabe
         -----------------------------------------------------------------------
         output : boolean
-            Gibt 'True' zurück, sofern der Check erfolgreich war.
+            Gibt 'True' zurück, sofern der Check erfolgreich war. Sonst wird
+            die gefundene Abweichung (LeafbankMismatchError) bzw. alle
+            gefundenen (MismatchCollectionError) geworfen.
         """
-        try:
-            for key in self.banks[0].header.keys():
-                if key in ["filename","side"]:
-                    if self.banks[0].header[key] == self.banks[1].header[key]:
-                        raise LeafbankMismatchError(self.dicom_header["plan_uid"],
-                            self.dicom_header["beam_number"],
-                            key,"can't be identical for both banks")
-                else:
-                    if self.banks[0].header[key] != self.banks[1].header[key]:
-                        raise LeafbankMismatchError(self.dicom_header["plan_uid"],
-                        self.dicom_header["beam_number"],key)
-
-                if not np.all(self.banks[0].dose_fraction ==
-                    self.banks[1].dose_fraction):
-                    raise LeafbankMismatchError(self.dicom_header["plan_uid"],
-                        self.dicom_header["beam_number"],"dose array")
-
-                if not np.all(self.banks[0].gantry_angle ==
-                    self.banks[1].gantry_angle):
-                    raise LeafbankMismatchError(self.dicom_header["plan_uid"],
-                        self.dicom_header["beam_number"],"gantry angle array")
-
-#                if not np.all(self.banks[0].previous_segment ==
-#                    self.banks[1].previous_segment):
-#                    raise LeafbankMismatchError(self.dicom_header["plan_uid"],
-#                        self.dicom_header["beam_number"],"previous segment array")
-        #derzeit nicht benötigte Daten, auskommentiert zwecks Beschleunigung.
-
-        except LeafbankMismatchError:
-            raise
-        else:
+        if len(self.banks) != 2:
+            self.checked = None
+            MismatchCollectionError.raise_errors(self.collect_leafbank_errors())
+        headers = [dict(bank.header) for bank in self.banks]
+        arrays = [getattr(bank,name) for name in ["dose_fraction",
+            "gantry_angle"] for bank in self.banks]
+        if self.checked != None and self.checked[0] == headers and \
+            all([old is new for old,new in zip(self.checked[1],arrays)]):
             return True
-        return False
+        self.checked = None
+        MismatchCollectionError.raise_errors(self.collect_leafbank_errors())
+        for data in arrays:
+            data.setflags(write=False)
+        #Änderungen an Ort und Stelle würden am Arrayobjekt nicht auffallen.
+        self.checked = (headers,arrays)
+        return True
+
+    def collect_leafbank_errors(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of LeafbankMismatchError
+            Alle Abweichungen zwischen den beiden Leafbänken. Header und
+            Arrays werden dabei je einmal verglichen.
+        """
+        if len(self.banks) != 2:
+            return [LeafbankMismatchError(self.dicom_header["plan_uid"],
+                self.dicom_header["beam_number"],"bank count","needs 2 "\
+                "leafbanks per beam, {0} were passed".format(len(self.banks)))]
+        errors = []
+        for key in self.banks[0].header.keys():
+            if key in ["filename","side"]:
+                if self.banks[0].header[key] == self.banks[1].header[key]:
+                    errors.append(LeafbankMismatchError(self.dicom_header[
+                        "plan_uid"],self.dicom_header["beam_number"],
+                        key,"can't be identical for both banks"))
+            elif self.banks[0].header[key] != self.banks[1].header[key]:
+                errors.append(LeafbankMismatchError(self.dicom_header[
+                    "plan_uid"],self.dicom_header["beam_number"],key))
+
+        for name,key in [("dose_fraction","dose array"),
+            ("gantry_angle","gantry angle array")]:
+            data = [getattr(bank,name) for bank in self.banks]
+            if data[0] is not data[1] and not np.array_equal(data[0],data[1]):
+                errors.append(LeafbankMismatchError(self.dicom_header[
+                    "plan_uid"],self.dicom_header["beam_number"],key))
+        #previous_segment wird nicht verglichen, da es nur für das Kriterium
+        #"segment" nachgeladen wird.
+        return errors
 
     def check_beam_metadata(self):
         """
@@ -527,42 +916,126 @@ class beam:
         Ausgabe
         -----------------------------------------------------------------------
         output : boolean
-            True wenn alles stimmt, Exception wenn nicht.
+            True wenn alles stimmt, Exception wenn nicht (bei mehreren
+            Abweichungen MismatchCollectionError).
         """
         if self.dicom_header == None:
             return None
-        try:
-            for key in self.dicom_header.keys():
-                if self.dicom_header[key] != self.log_header[key]:
-                    raise BeamMismatchError(self.dicom_header["plan_uid"],
-                    self.dicom_header["beam_number"],key)
-        except BeamMismatchError:
-            raise
-        else:
-            return True
-        return False
+        MismatchCollectionError.raise_errors(self.collect_beam_errors())
+        return True
+
+    def collect_beam_errors(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : list of BeamMismatchError
+            Alle Abweichungen zwischen DICOM- und DynaLog-Header.
+        """
+        return [BeamMismatchError(self.dicom_header["plan_uid"],
+            self.dicom_header["beam_number"],key) for key in
+            self.dicom_header.keys() if self.dicom_header[key] !=
+            self.log_header[key]]
 
     def validate_beam(self):
         """
         Beschreibung
         -----------------------------------------------------------------------
-        Ruft check_beam auf, und setzt, falls erfolgreich, 'validated' auf True.
+        Ruft check_leafbank_data und check_beam_metadata auf, und setzt, falls
+        erfolgreich, 'validated' auf True. Abweichungen aus beiden Prüfungen
+        werden gemeinsam gemeldet.
         """
-        try:
-            self.check_leafbank_data()
-            self.check_beam_metadata()
-        except BeamMismatchError:
-            self.validated = False
-            raise
-        else:
-            self.validated = True
+        errors = []
+        for check in [self.check_leafbank_data,self.check_beam_metadata]:
+            try:
+                check()
+            except DynalogMismatchError as error:
+                errors.append(error)
+        self.validated = len(errors) == 0
+        MismatchCollectionError.raise_errors(errors)
+
+class dataset_pool:
+
+    def __init__(self,budget=256*1024**2):
+        """
+        Parameter
+        -----------------------------------------------------------------------
+        budget : int, default 256 MB
+            Maximale Summe der Dateigrößen aller vorgehaltenen Datensätze in
+            Byte. Der zuletzt geladene Datensatz bleibt immer erhalten.
+
+        Funktionen
+        -----------------------------------------------------------------------
+        get :
+            Liefert den Datensatz einer Datei, lädt ihn bei Bedarf.
+
+        release :
+            Entfernt den Datensatz einer Datei aus dem Pool.
+
+        Beschreibung
+        -----------------------------------------------------------------------
+        Least-recently-used Pool für DICOM-Datensätze, über den Plan-Objekte
+        ohne eigene Kopie ihr dicom_data beziehen. Wird das Budget
+        überschritten, werden die am längsten nicht verwendeten Datensätze
+        verworfen und beim nächsten Zugriff neu gelesen. Threadsicher, da der
+        Export in eigenen Threads läuft.
+        """
+        self.budget = budget
+        self.datasets = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self,filename):
+        with self.lock:
+            if filename in self.datasets:
+                entry = self.datasets.pop(filename)
+                self.datasets[filename] = entry
+                return entry[0]
+
+            dataset = dcm.read_file(filename)
+            size = os.path.getsize(filename)
+            self.datasets[filename] = (dataset,size)
+            self.size += size
+            while self.size > self.budget and len(self.datasets) > 1:
+                self.size -= self.datasets.popitem(last=False)[1][1]
+            return dataset
+
+    def release(self,filename):
+        with self.lock:
+            if filename in self.datasets:
+                self.size -= self.datasets.pop(filename)[1]
+
+datasets = dataset_pool()
+#Gemeinsamer Pool aller Pläne, die aus Dateinamen erzeugt werden.
 
 class plan:
 
-    def __init__(self,dicom_file):
+    def __init__(self,dicom_file,header=None,arcs=None,pool=None,data=None):
         """
         Parameter
         -----------------------------------------------------------------------
+        dicom_file : dicom.dataset.FileDataset or str
+            Der DICOM-Plan, oder der Pfad der Datei. Bei einem Pfad wird der
+            Datensatz nicht im Planobjekt gehalten, sondern bei jedem Zugriff
+            auf dicom_data aus dem dataset_pool bezogen.
+
+        header : dict, default None
+            Bereits bekannte Metadaten (plan_uid, patient_id, plan_name,
+            patient_name), z.B. aus einem log_index. Nur zusammen mit arcs
+            und einem Pfad in dicom_file; die Datei wird dann beim Erstellen
+            gar nicht gelesen.
+
+        arcs : int, default None
+            Anzahl der dynamischen Beams, siehe header.
+
+        pool : dataset_pool, default None
+            Pool, aus dem dicom_data bezogen wird. Standard ist der
+            modulweite Pool datasets.
+
+        data : dict, default None
+            Ausgelesene Plandaten, siehe extract_data, z.B. aus einem
+            import_tools.plan_cache. Ersetzt header und arcs; DICOM wird dann
+            erst beim Export gelesen.
+
         plan_uid : str
             Die UID des zu erstellenden Plans.
 
@@ -587,6 +1060,12 @@ class plan:
         invalidate_plan :
             'validated' wird False gesetzt.
 
+        release :
+            Gibt Beams und damit den DICOM-Datensatz wieder frei.
+
+        extract_data :
+            Liest Header und Sollwerte aller Beams aus dem DICOM-Datensatz.
+
         change_header_data :
             Ändert Werte von vorhandenen Datenfeldern in 'header'.
 
@@ -605,23 +1084,96 @@ class plan:
         -----------------------------------------------------------------------
         Fasst Beams zu Plänen zusammen. Bietet wiederum Möglichkeit zur
         Validierung.
+
+        Wird der Plan aus einem Dateinamen erzeugt, hält er selbst nur header
+        und arcs. dicom_data und beams werden bei Bedarf (construct_logbeams,
+        export_dynalog_plan) über __getattr__ geladen und mit release wieder
+        freigegeben.
+
+        Beams werden aus den Arrays in data konstruiert, die ebenfalls erst
+        bei Bedarf ausgelesen werden. Rekonstruktion und Statistik kommen
+        damit ohne DICOM-Zugriff aus, sofern data übergeben wurde.
+        """
+        self.validated = False
+        if hasattr(dicom_file,"BeamSequence"):
+            self.dicom_data = dicom_file
+            self.header = {}
+            self.construct_header()
+            self.arcs = 0
+            self.construct_dicombeams()
+            return None
+
+        self.filename = dicom_file
+        if pool != None:
+            self.pool = pool
+        if data != None:
+            self.data = data
+            self.header = dict(data["header"])
+            self.arcs = len([beam_data for beam_data in data["beams"]
+                if beam_data["beam_type"] == "DYNAMIC"])
+        elif header != None and arcs != None:
+            self.header = dict([(key,header[key]) for key in ["plan_uid",
+                "patient_id","plan_name","patient_name"]])
+            self.arcs = arcs
+        else:
+            self.header = {}
+            self.construct_header()
+            self.arcs = 0
+            self.construct_dicombeams()
+            self.release()
+
+    def __getattr__(self,name):
+        """
+        Lädt dicom_data aus dem dataset_pool bzw. baut die Beamliste neu auf,
+        falls sie mit release freigegeben wurde.
         """
+        if name == "dicom_data" and "filename" in self.__dict__:
+            return self.__dict__.get("pool",datasets).get(self.filename)
+        if name == "beams" and "header" in self.__dict__:
+            self.arcs = 0
+            self.construct_dicombeams()
+            return self.__dict__["beams"]
+        if name == "data" and "header" in self.__dict__:
+            self.data = self.extract_data()
+            return self.data
+        raise AttributeError(name)
+
+    def release(self):
+        """
+        Beschreibung
+        -----------------------------------------------------------------------
+        Verwirft die Beamliste samt der darin gehaltenen Leafbänke und DICOM-
+        Beams. Bei Plänen, die aus einem Dateinamen erzeugt wurden, hält das
+        Planobjekt danach keine Referenz mehr auf den Datensatz, der dann nur
+        noch dem Speicherbudget des dataset_pool unterliegt. Der Plan muss vor
+        dem nächsten Export neu konstruiert und validiert werden.
+        """
+        self.__dict__.pop("beams",None)
         self.validated = False
-        self.header = {}
-        self.dicom_data = dicom_file
-        self.construct_header()
-        self.arcs = 0
-        self.construct_dicombeams()
 
 
+    def extract_data(self):
+        """
+        Ausgabe
+        -----------------------------------------------------------------------
+        output : dict
+            "header" (wie self.header) und "beams", eine Liste mit dem Ergebnis
+            von beam.extract_dicomdata für jeden Beam der BeamSequence.
+        """
+        if len(self.header) == 0:
+            self.construct_header()
+        return {"header":copy.deepcopy(self.header),
+            "beams":[beam.extract_dicomdata(dicom_beam)
+                for dicom_beam in self.dicom_data.BeamSequence]}
+
     def construct_dicombeams(self):
         self.beams = []
-        for beam in self.dicom_data.BeamSequence:
-            if beam.BeamType == "DYNAMIC":
+        for beam_data in self.data["beams"]:
+            if beam_data["beam_type"] == "DYNAMIC":
                 self.beams.append("dynamic")
                 self.arcs += 1
             else:
-                self.beams.append(beam)
+                self.beams.append("static")
 
     def construct_header(self):
         """
@@ -660,11 +1212,10 @@ class plan:
                 beam_header = copy.deepcopy(self.header)
                 del beam_header["plan_name"]
                 beam_header["beam_number"] = num+1
-                beam_header["leaf_count"] = int(self.dicom_data.\
-                    BeamSequence[num].BeamLimitingDeviceSequence[2].\
-                    NumberOfLeafJawPairs)
+                beam_header["leaf_count"] = self.data["beams"][num]["leaf_count"]
 
-                self.beams[num] = beam(None,beam_header,self.dicom_data.BeamSequence[num])
+                self.beams[num] = beam(None,beam_header,
+                    beam_data=self.data["beams"][num])
 
 
         elif len(bank_pool) != 2*len(self.beams):
@@ -680,13 +1231,11 @@ class plan:
                 beam_header = copy.deepcopy(self.header)
                 del beam_header["plan_name"]
                 beam_header["beam_number"] = num+1
-                beam_header["leaf_count"] = int(self.dicom_data.
-                    BeamSequence[num].BeamLimitingDeviceSequence[2].
-                    NumberOfLeafJawPairs)
+                beam_header["leaf_count"] = self.data["beams"][num]["leaf_count"]
 
                 self.beams[num] = beam([bank_pool[sort_index[2*num]],
                        bank_pool[sort_index[2*num+1]]],beam_header,
-                        self.dicom_data.BeamSequence[num])
+                        beam_data=self.data["beams"][num])
 
 #        self.validate_plan()
 
@@ -696,30 +1245,32 @@ class plan:
         -----------------------------------------------------------------------
         Prüft Konsistenz der Metadaten zwischen Beams und Leafbanks sowie Beams
         und Plan. Wirft Exception falls Abweichungen vorhanden sind, gibt
-        ansonsten True zurück.
+        ansonsten True zurück. Alle Beams werden geprüft, gefundene
+        Abweichungen werden gemeinsam als MismatchCollectionError gemeldet.
+        Unveränderte Beams werden dabei nicht erneut verglichen (siehe
+        beam.check_leafbank_data).
 
         Ausgabe
         -----------------------------------------------------------------------
         output : boolean
         """
-        try:
-            for num in range(len(self.beams)):
+        errors = []
+        for num in range(len(self.beams)):
+            try:
                 self.beams[num].validate_beam()
-                if self.beams[num].log_header["beam_number"] != num+1:
-                    raise PlanMismatchError(self.header["plan_uid"],
-                    "beam assignment","beam at index {0} of beam list"\
-                    " identifies as beam {1} instead of beam {2}."\
-                    .format(num,self.beams[num].log_header["beam_number"],num+1))
-            if len(self.beams) != len(self.dicom_data.BeamSequence):
-                raise PlanMismatchError(self.header["plan_uid"],"beam count",
-                "beam list contains {0} entries, plan header requires {1}."\
-                .format(len(self.beams),len(self.dicom_data.BeamSequence)))
-        except PlanMismatchError:
-            raise
-            return False
-        else:
-            return True
-        return False
+            except DynalogMismatchError as error:
+                errors.append(error)
+            if self.beams[num].log_header["beam_number"] != num+1:
+                errors.append(PlanMismatchError(self.header["plan_uid"],
+                "beam assignment","beam at index {0} of beam list"\
+                " identifies as beam {1} instead of beam {2}."\
+                .format(num,self.beams[num].log_header["beam_number"],num+1)))
+        if len(self.beams) != len(self.data["beams"]):
+            errors.append(PlanMismatchError(self.header["plan_uid"],"beam count",
+            "beam list contains {0} entries, plan header requires {1}."\
+            .format(len(self.beams),len(self.data["beams"]))))
+        MismatchCollectionError.raise_errors(errors)
+        return True
 
     def validate_plan(self):
         """
@@ -730,7 +1281,7 @@ class plan:
         """
         try:
             self.validated = self.check_plan()
-        except PlanMismatchError:
+        except DynalogMismatchError:
             self.validated = False
             raise
 
@@ -805,7 +1356,8 @@ class plan:
 #                beam.validate_beam()
 #            self.check_plan()
 
-    def export_dynalog_plan(self,plan_name,filename,export_expected=False,leafgap=0.7):
+    def export_dynalog_plan(self,plan_name,filename,export_expected=False,
+        leafgap=0.7,interpolate=False,criterion="angle"):
         """
         Parameter
         -----------------------------------------------------------------------
@@ -821,12 +1373,19 @@ class plan:
             Der Dateiname, unter dem das exportierte RTPLAN Objekt abgelegt
             werden soll.
 
+        interpolate, criterion :
+            Siehe beam.export_logbeam.
+
         Beschreibung
         -----------------------------------------------------------------------
         Exportiert den derzeitigen Planzustand als DICOM-Objekt. Basis ist eine
-        Kopie des DICOM-Files mit dem der Plan initialisiert wurde. StudyInstance,
-        SeriesInstance und Study UIDs werden ersetzt/geändert. Alle im DynaLog
-        enthaltenen Werte werden anstelle der Originalparameter exportiert.
+        flache Kopie des DICOM-Files mit dem der Plan initialisiert wurde, in
+        der nur die geänderten Elemente ersetzt werden (siehe
+        beam.replace_elements). Der Datensatz im dataset_pool bleibt dadurch
+        unverändert und kann für weitere Fraktionen wiederverwendet werden.
+        StudyInstance, SeriesInstance und Study UIDs werden ersetzt/geändert.
+        Alle im DynaLog enthaltenen Werte werden anstelle der Originalparameter
+        exportiert.
 
         Plan muss validiert sein bevor der Export erfolgen kann!
 
@@ -839,25 +1398,29 @@ class plan:
         if self.validated == False:
             raise PlanMismatchError(self.header["plan_uid"],"validation",
             "can't export unvalidated plan.")
-        exportplan = copy.deepcopy(self.dicom_data)
+        beams = []
         for num in range(len(self.beams)):
-            exportplan.BeamSequence[num] = self.beams[num].export_logbeam(export_expected,leafgap)
-        exportplan.RTPlanLabel = ("dyn_"+plan_name)[:13]
+            if self.beams[num].dicom_beam == None:
+                self.beams[num].dicom_beam = self.dicom_data.BeamSequence[num]
+            beams.append(self.beams[num].export_logbeam(export_expected,
+                leafgap,interpolate,criterion))
 
         ltime = time.localtime()
-        study_instance = exportplan.StudyInstanceUID.split(".")
-        series_instance = exportplan.SeriesInstanceUID.split(".")
-        instance_id = exportplan.SOPInstanceUID.split(".")
-
-        exportplan.StudyInstanceUID = ".".join(study_instance[:-1])+\
-            "."+"".join([str(t) for t in ltime[3:6]])
-        exportplan.SeriesInstanceUID = ".".join(series_instance[:-1])+\
-            "."+"".join([str(t) for t in ltime[:6]])
-        exportplan.StudyID = "Id"+\
-            "".join([str(t) for t in ltime[3:6]])
-        exportplan.SOPInstanceUID = ".".join(instance_id[:-1])+\
-            "."+"".join([str(t) for t in ltime[:6]])
-        exportplan.ApprovalStatus = "UNAPPROVED"
+        study_instance = self.dicom_data.StudyInstanceUID.split(".")
+        series_instance = self.dicom_data.SeriesInstanceUID.split(".")
+        instance_id = self.dicom_data.SOPInstanceUID.split(".")
+
+        exportplan = beam.replace_elements(self.dicom_data,
+            BeamSequence=beams,
+            RTPlanLabel=("dyn_"+plan_name)[:13],
+            StudyInstanceUID=".".join(study_instance[:-1])+\
+                "."+"".join([str(t) for t in ltime[3:6]]),
+            SeriesInstanceUID=".".join(series_instance[:-1])+\
+                "."+"".join([str(t) for t in ltime[:6]]),
+            StudyID="Id"+"".join([str(t) for t in ltime[3:6]]),
+            SOPInstanceUID=".".join(instance_id[:-1])+\
+                "."+"".join([str(t) for t in ltime[:6]]),
+            ApprovalStatus="UNAPPROVED")
         dcm.write_file(filename,exportplan)
 
 #    def strip_privates(self,plan):